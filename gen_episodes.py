@@ -0,0 +1,52 @@
+import os
+import argparse
+
+import cv2
+
+from util import dataset, config
+
+cv2.ocl.setUseOpenCL(False)
+cv2.setNumThreads(0)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Generate a fixed evaluation episode list for few-shot segmentation')
+    parser.add_argument('--config', type=str, default='config/pascal/pascal_split0_resnet50.yaml', help='config file')
+    parser.add_argument('--num', type=int, default=None, help='number of episodes (default: 20000 for coco, 5000 for pascal)')
+    parser.add_argument('--output', type=str, default=None, help='episode list to write (default: episode_list in config)')
+    parser.add_argument('opts', help='see config/pascal/pascal_split0_resnet50.yaml for all options', default=None,
+                        nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+    assert args.config is not None
+    cfg = config.load_cfg_from_cfg_file(args.config)
+    if args.opts is not None:
+        cfg = config.merge_cfg_from_list(cfg, args.opts)
+    cfg.episode_num = args.num
+    cfg.episode_list = args.output or cfg.get('episode_list', None)
+    return cfg
+
+
+def main():
+    args = get_parser()
+    assert args.episode_list, 'set episode_list in the config or pass --output'
+
+    val_data = dataset.SemData(split=args.split, shot=args.shot, data_root=args.data_root, \
+                               data_list=args.val_list, transform=None, mode='val', \
+                               use_coco=args.use_coco, use_split_coco=args.use_split_coco, args=args)
+    episode_num = args.episode_num
+    if episode_num is None:
+        if args.split != 999:
+            episode_num = 20000 if args.use_coco else 5000
+        else:
+            episode_num = len(val_data)
+
+    episodes = dataset.make_episodes(val_data, episode_num, seed=args.manual_seed)
+    episode_dir = os.path.dirname(args.episode_list)
+    if episode_dir and not os.path.exists(episode_dir):
+        os.makedirs(episode_dir)
+    dataset.save_episodes(episodes, args.episode_list, data_root=args.data_root)
+    print('Saved {} episodes (split {}, {}-shot) to {}'.format(len(episodes), args.split, args.shot, args.episode_list))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+import argparse
+
+from util import lists
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Merge, deduplicate, split and check train/val list files')
+    sub = parser.add_subparsers(dest='command')
+    sub.required = True
+
+    p = sub.add_parser('merge', help='concatenate lists and remove duplicate lines (also for a single list)')
+    p.add_argument('inputs', nargs='+', help='list files, e.g. lists/pascal/voc_original_train.txt lists/pascal/sbd_data.txt')
+    p.add_argument('--output', required=True, help='merged list, e.g. lists/pascal/voc_sbd_merge_noduplicate.txt')
+
+    p = sub.add_parser('split', help='split a list into train/val by a stable hash of the image path')
+    p.add_argument('input', help='list file')
+    p.add_argument('--train', required=True, help='train list to write')
+    p.add_argument('--val', required=True, help='val list to write')
+    p.add_argument('--val_ratio', type=float, default=0.1, help='fraction of the images in the val list')
+    p.add_argument('--seed', type=int, default=0, help='different seeds give different splits')
+
+    p = sub.add_parser('check', help='report lines whose image or label file does not exist')
+    p.add_argument('inputs', nargs='+', help='list files')
+    p.add_argument('--data_root', default='', help='root the list paths are relative to (data_root in the config)')
+    return parser.parse_args()
+
+
+def main():
+    args = get_parser()
+    if args.command == 'merge':
+        count = lists.write_list(lists.merge(args.inputs), args.output)
+        total = sum(1 for data_list in args.inputs for _ in lists.read_list(data_list))
+        print('Ori: {}, new: {}'.format(total, count))
+    elif args.command == 'split':
+        train_num, val_num = lists.split(lists.read_list(args.input), args.train, args.val, args.val_ratio, args.seed)
+        print('train: {}, val: {}'.format(train_num, val_num))
+    elif args.command == 'check':
+        missing = 0
+        for data_list in args.inputs:
+            for idx, path in lists.missing_files(lists.read_list(data_list), args.data_root):
+                print('{} entry {}: missing {}'.format(data_list, idx + 1, path))
+                missing += 1
+        print('{} missing files'.format(missing))
+        if missing:
+            raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
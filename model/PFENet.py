@@ -3,6 +3,7 @@
 import torch
 from torch import nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 import numpy as np
 import random
 import time
@@ -49,7 +50,8 @@ def get_vgg16_layer(model):
 
 class PFENet(nn.Module):
     def __init__(self, layers=50, classes=2, zoom_factor=8, criterion=nn.CrossEntropyLoss(ignore_index=255),
-                 BatchNorm=nn.BatchNorm2d, pretrained=True, sync_bn=True, shot=1, ppm_scales=[60, 30, 15, 8], vgg=False):
+                 BatchNorm=nn.BatchNorm2d, pretrained=True, sync_bn=True, shot=1, ppm_scales=[60, 30, 15, 8], vgg=False,
+                 checkpoint_head=False):
         super(PFENet, self).__init__()
         assert layers in [50, 101, 152]
         print('ppm_scale',ppm_scales)
@@ -60,6 +62,7 @@ class PFENet(nn.Module):
         self.shot = shot
         self.ppm_scales = ppm_scales
         self.vgg = vgg
+        self.checkpoint_head = checkpoint_head    # 训练时不保存每个 pyramid bin 的中间 activation, backward 时重新计算
 
         models.BatchNorm = BatchNorm
         
@@ -93,6 +96,19 @@ class PFENet(nn.Module):
                 elif 'downsample.0' in n:
                     m.stride = (1, 1)
 
+        # backbone 的每个参数/buffer 在预训练权重文件 (initmodel, 见 util.weight_store) 中的 key
+        self.backbone_path = vgg_models.model_paths['vgg16_bn'] if self.vgg else models.model_paths['resnet{}'.format(layers)]
+        backbone = vgg16 if self.vgg else resnet
+        module_names = {id(m): n for n, m in backbone.named_modules()}
+        self.backbone_keys = {}
+        for name, m in self.named_modules():
+            if id(m) in module_names and m is not backbone:
+                prefix = module_names[id(m)]
+                for k, _ in m.named_parameters(recurse=False):
+                    self.backbone_keys['{}.{}'.format(name, k)] = '{}.{}'.format(prefix, k)
+                for k, _ in m.named_buffers(recurse=False):
+                    self.backbone_keys['{}.{}'.format(name, k)] = '{}.{}'.format(prefix, k)
+
         reduce_dim = 256
         if self.vgg:
             fea_dim = 512 + 256
@@ -176,13 +192,62 @@ class PFENet(nn.Module):
      
 
 
-    def forward(self, x, s_x, s_y, y=None):
+    def forward(self, x, s_x, s_y, y=None, s_valid=None):
         # s_x=torch.FloatTensor(1,1,3,473,473).cuda(), s_y=torch.FloatTensor(1,1,473,473).cuda()
+        # s_valid: [B, K] bool, 标记 episode_collate 补齐的 support (None: 全部有效)
         x_size = x.size()
         assert (x_size[2]-1) % 8 == 0 and (x_size[3]-1) % 8 == 0
         h = int((x_size[2] - 1) / 8 * self.zoom_factor + 1)
         w = int((x_size[3] - 1) / 8 * self.zoom_factor + 1)
 
+        query_feat, query_feat_4 = self.extract_query_feat(x)
+        supp_feat_list, corr_query_mask_list = self.extract_supp_feat(s_x, s_y, query_feat, query_feat_4, self.shot)
+        out, out_list = self.decode(query_feat, supp_feat_list, corr_query_mask_list,
+                                    s_valid[:, :self.shot] if s_valid is not None else None)
+
+        # Output Part
+        if self.zoom_factor != 1:
+            out = F.interpolate(out, size=(h, w), mode='bilinear', align_corners=True)
+
+        if self.training:
+            main_loss = self.criterion(out, y.long())
+            aux_loss = torch.zeros_like(main_loss)      # .cuda()    # aux loss初始化为0
+            if main_loss.is_cuda:
+                aux_loss = aux_loss.cuda()
+
+            for idx_k in range(len(out_list)):    
+                inner_out = out_list[idx_k]
+                inner_out = F.interpolate(inner_out, size=(h, w), mode='bilinear', align_corners=True)
+                aux_loss = aux_loss + self.criterion(inner_out, y.long())   
+            aux_loss = aux_loss / len(out_list)
+            return out.max(1)[1], main_loss, aux_loss    # 输出的out 为 [B, h, w]只给出max所对应的class index
+        else:
+            return out
+
+    def forward_variants(self, x, s_x, s_y, variants, s_valid=None):
+        # eval only: 对同一个 query 用不同的 support 组合预测, query 和每张 support 的 backbone feature 只计算一次
+        # variants: list of support index lists (w.r.t. s_x[:, k]), 返回每个组合的 logit [B, 2, h, w]
+        x_size = x.size()
+        assert (x_size[2]-1) % 8 == 0 and (x_size[3]-1) % 8 == 0
+        h = int((x_size[2] - 1) / 8 * self.zoom_factor + 1)
+        w = int((x_size[3] - 1) / 8 * self.zoom_factor + 1)
+
+        query_feat, query_feat_4 = self.extract_query_feat(x)
+        used = sorted(set(k for variant in variants for k in variant))
+        supp_feat_list, corr_query_mask_list = self.extract_supp_feat(s_x[:, used], s_y[:, used], query_feat, query_feat_4, len(used))
+        pos = {k: i for i, k in enumerate(used)}
+
+        out_variants = []
+        for variant in variants:
+            out, _ = self.decode(query_feat, [supp_feat_list[pos[k]] for k in variant],
+                                 [corr_query_mask_list[pos[k]] for k in variant],
+                                 s_valid[:, variant] if s_valid is not None else None)
+            if self.zoom_factor != 1:
+                out = F.interpolate(out, size=(h, w), mode='bilinear', align_corners=True)
+            out_variants.append(out)
+        return out_variants
+
+    def extract_query_feat(self, x):
         #   Query Feature
         with torch.no_grad():
             query_feat_0 = self.layer0(x)
@@ -195,14 +260,16 @@ class PFENet(nn.Module):
 
         query_feat = torch.cat([query_feat_3, query_feat_2], 1)  # [B, 512+1024, h, w]
         query_feat = self.down_query(query_feat)                 # [B, reduce_dim = 256, h, w]
+        return query_feat, query_feat_4
 
-        #   Support Feature: 根据Layer2 & layer3生成prototype
+    def extract_supp_feat(self, s_x, s_y, query_feat, query_feat_4, shot):
+        #   Support Feature: 根据Layer2 & layer3生成prototype, 根据layer4生成prior mask
         supp_feat_list = []
-        final_supp_list = []
-        mask_list = []
-        for i in range(self.shot):
+        corr_query_mask_list = []
+        cosine_eps = 1e-7
+        for i in range(shot):
             mask = (s_y[:,i,:,:] == 1).float().unsqueeze(1)  # [1, 1, h, w]
-            mask_list.append(mask)
+            full_mask = mask
             with torch.no_grad():
                 supp_feat_0 = self.layer0(s_x[:,i,:,:,:])    # [1, 3, h, w]
                 supp_feat_1 = self.layer1(supp_feat_0)
@@ -210,7 +277,6 @@ class PFENet(nn.Module):
                 supp_feat_3 = self.layer3(supp_feat_2)       # [1, 1024, h, w]
                 mask = F.interpolate(mask, size=(supp_feat_3.size(2), supp_feat_3.size(3)), mode='bilinear', align_corners=True)
                 supp_feat_4 = self.layer4(supp_feat_3*mask)
-                final_supp_list.append(supp_feat_4)
                 if self.vgg:
                     supp_feat_2 = F.interpolate(supp_feat_2, size=(supp_feat_3.size(2),supp_feat_3.size(3)), mode='bilinear', align_corners=True)
             
@@ -219,14 +285,10 @@ class PFENet(nn.Module):
             supp_feat = Weighted_GAP(supp_feat, mask)
             supp_feat_list.append(supp_feat)                # prototype [reduce_dim*1]
 
+            resize_size = supp_feat_4.size(2)
+            tmp_mask = F.interpolate(full_mask, size=(resize_size, resize_size), mode='bilinear', align_corners=True)
 
-        corr_query_mask_list = []
-        cosine_eps = 1e-7
-        for i, tmp_supp_feat in enumerate(final_supp_list):
-            resize_size = tmp_supp_feat.size(2)
-            tmp_mask = F.interpolate(mask_list[i], size=(resize_size, resize_size), mode='bilinear', align_corners=True)
-
-            tmp_supp_feat_4 = tmp_supp_feat * tmp_mask                    
+            tmp_supp_feat_4 = supp_feat_4 * tmp_mask                    
             q = query_feat_4     # [B, 2048, h, w]
             s = tmp_supp_feat_4
             bsize, ch_sz, sp_sz, _ = q.size()[:]
@@ -244,71 +306,75 @@ class PFENet(nn.Module):
             similarity = similarity.max(1)[0].view(bsize, sp_sz*sp_sz)   # get the max across s-dimension
             similarity = (similarity - similarity.min(1)[0].unsqueeze(1))/(similarity.max(1)[0].unsqueeze(1) - similarity.min(1)[0].unsqueeze(1) + cosine_eps)
             corr_query = similarity.view(bsize, 1, sp_sz, sp_sz)         # [B, 1, h, w]
-            corr_query = F.interpolate(corr_query, size=(query_feat_3.size()[2], query_feat_3.size()[3]), mode='bilinear', align_corners=True)
+            corr_query = F.interpolate(corr_query, size=(query_feat.size()[2], query_feat.size()[3]), mode='bilinear', align_corners=True)
             corr_query_mask_list.append(corr_query)
-        corr_query_mask = torch.cat(corr_query_mask_list, 1).mean(1).unsqueeze(1)    # 根据每一个support image产生的heat map, 取平均, [B, 1, h3, w3]
-        corr_query_mask = F.interpolate(corr_query_mask, size=(query_feat.size(2), query_feat.size(3)), mode='bilinear', align_corners=True)  
-
-        # get the prototype (layer2+layer3) based on k support images
-        if self.shot > 1:
+        return supp_feat_list, corr_query_mask_list
+
+    def decode(self, query_feat, supp_feat_list, corr_query_mask_list, s_valid=None):
+        if s_valid is not None and not bool(s_valid.all()):
+            # 只对有效的 support 取平均 (每个 episode 至少有一张有效 support)
+            weight = s_valid.to(query_feat.dtype)
+            weight = weight / weight.sum(1, keepdim=True)                               # [B, K]
+            corr_query_mask = (torch.cat(corr_query_mask_list, 1) * weight[:, :, None, None]).sum(1, keepdim=True)
+            supp_feat = sum(feat * weight[:, k, None, None, None] for k, feat in enumerate(supp_feat_list))
+        else:
+            corr_query_mask = torch.cat(corr_query_mask_list, 1).mean(1).unsqueeze(1)    # 根据每一个support image产生的heat map, 取平均, [B, 1, h3, w3]
+            # get the prototype (layer2+layer3) based on k support images
             supp_feat = supp_feat_list[0]
-            for i in range(1, len(supp_feat_list)):
-                supp_feat += supp_feat_list[i]
-            supp_feat /= len(supp_feat_list)
+            if len(supp_feat_list) > 1:
+                for i in range(1, len(supp_feat_list)):
+                    supp_feat = supp_feat + supp_feat_list[i]      # 不能in-place, supp_feat_list 可能被多个 variant 共用
+                supp_feat = supp_feat / len(supp_feat_list)
+        corr_query_mask = F.interpolate(corr_query_mask, size=(query_feat.size(2), query_feat.size(3)), mode='bilinear', align_corners=True)  
 
         out_list = [] # 每个pyramid level的classification pred 用于aux loss
         pyramid_feat_list = []
+        use_checkpoint = self.checkpoint_head and self.training and torch.is_grad_enabled()
 
-        for idx, tmp_bin in enumerate(self.pyramid_bins):
-            if tmp_bin <= 1.0:
-                bin = int(query_feat.shape[2] * tmp_bin)   # if bin=0.5 then bin = 0.5*h
-                query_feat_bin = nn.AdaptiveAvgPool2d(bin)(query_feat)
+        for idx in range(len(self.pyramid_bins)):
+            pre_feat = pyramid_feat_list[idx-1] if idx >= 1 else None
+            if use_checkpoint:
+                merge_feat_bin, inner_out_bin = checkpoint(self.bin_forward, idx, query_feat, supp_feat, corr_query_mask, pre_feat,
+                                                           use_reentrant=False)
             else:
-                bin = tmp_bin
-                query_feat_bin = self.avgpool_list[idx](query_feat)
-            supp_feat_bin = supp_feat.expand(-1, -1, bin, bin)
-            corr_mask_bin = F.interpolate(corr_query_mask, size=(bin, bin), mode='bilinear', align_corners=True)
-            merge_feat_bin = torch.cat([query_feat_bin, supp_feat_bin, corr_mask_bin], 1)    # query + prototype + prior, dim[B, rd_dim*2+1, bin, bin]
-            merge_feat_bin = self.init_merge[idx](merge_feat_bin)                            # [B, rd_dim, bin, bin]
-
-            if idx >= 1:
-                pre_feat_bin = pyramid_feat_list[idx-1].clone()
-                pre_feat_bin = F.interpolate(pre_feat_bin, size=(bin, bin), mode='bilinear', align_corners=True)
-                rec_feat_bin = torch.cat([merge_feat_bin, pre_feat_bin], 1)
-                merge_feat_bin = self.alpha_conv[idx-1](rec_feat_bin) + merge_feat_bin  
-
-            merge_feat_bin = self.beta_conv[idx](merge_feat_bin) + merge_feat_bin   
-            inner_out_bin = self.inner_cls[idx](merge_feat_bin)
-            merge_feat_bin = F.interpolate(merge_feat_bin, size=(query_feat.size(2), query_feat.size(3)), mode='bilinear', align_corners=True)
+                merge_feat_bin, inner_out_bin = self.bin_forward(idx, query_feat, supp_feat, corr_query_mask, pre_feat)
             pyramid_feat_list.append(merge_feat_bin)
             out_list.append(inner_out_bin)
-                 
+
+        if use_checkpoint:
+            query_feat = checkpoint(self.merge_pyramid, *pyramid_feat_list, use_reentrant=False)
+        else:
+            query_feat = self.merge_pyramid(*pyramid_feat_list)
+        out = self.cls(query_feat)    # [B, 2, h, w]
+        return out, out_list
+
+    def bin_forward(self, idx, query_feat, supp_feat, corr_query_mask, pre_feat=None):
+        # 第 idx 个 pyramid level: query + prototype + prior 融合, pre_feat 为上一个 level 的输出
+        tmp_bin = self.pyramid_bins[idx]
+        if tmp_bin <= 1.0:
+            bin = int(query_feat.shape[2] * tmp_bin)   # if bin=0.5 then bin = 0.5*h
+            query_feat_bin = nn.AdaptiveAvgPool2d(bin)(query_feat)
+        else:
+            bin = tmp_bin
+            query_feat_bin = self.avgpool_list[idx](query_feat)
+        supp_feat_bin = supp_feat.expand(-1, -1, bin, bin)
+        corr_mask_bin = F.interpolate(corr_query_mask, size=(bin, bin), mode='bilinear', align_corners=True)
+        merge_feat_bin = torch.cat([query_feat_bin, supp_feat_bin, corr_mask_bin], 1)    # query + prototype + prior, dim[B, rd_dim*2+1, bin, bin]
+        merge_feat_bin = self.init_merge[idx](merge_feat_bin)                            # [B, rd_dim, bin, bin]
+
+        if idx >= 1:
+            pre_feat_bin = pre_feat.clone()
+            pre_feat_bin = F.interpolate(pre_feat_bin, size=(bin, bin), mode='bilinear', align_corners=True)
+            rec_feat_bin = torch.cat([merge_feat_bin, pre_feat_bin], 1)
+            merge_feat_bin = self.alpha_conv[idx-1](rec_feat_bin) + merge_feat_bin  
+
+        merge_feat_bin = self.beta_conv[idx](merge_feat_bin) + merge_feat_bin   
+        inner_out_bin = self.inner_cls[idx](merge_feat_bin)
+        merge_feat_bin = F.interpolate(merge_feat_bin, size=(query_feat.size(2), query_feat.size(3)), mode='bilinear', align_corners=True)
+        return merge_feat_bin, inner_out_bin
+
+    def merge_pyramid(self, *pyramid_feat_list):
         query_feat = torch.cat(pyramid_feat_list, 1)        # 所有pyramid level所得到的feature concat, 求最终的output
         query_feat = self.res1(query_feat)
         query_feat = self.res2(query_feat) + query_feat           
-        out = self.cls(query_feat)    # [B, 2, h, w]
-        
-
-        # Output Part
-        if self.zoom_factor != 1:
-            out = F.interpolate(out, size=(h, w), mode='bilinear', align_corners=True)
-
-        if self.training:
-            main_loss = self.criterion(out, y.long())
-            aux_loss = torch.zeros_like(main_loss)      # .cuda()    # aux loss初始化为0
-            if main_loss.is_cuda:
-                aux_loss = aux_loss.cuda()
-
-            for idx_k in range(len(out_list)):    
-                inner_out = out_list[idx_k]
-                inner_out = F.interpolate(inner_out, size=(h, w), mode='bilinear', align_corners=True)
-                aux_loss = aux_loss + self.criterion(inner_out, y.long())   
-            aux_loss = aux_loss / len(out_list)
-            return out.max(1)[1], main_loss, aux_loss    # 输出的out 为 [B, h, w]只给出max所对应的class index
-        else:
-            return out
-
-
-
-
-
+        return query_feat
@@ -17,6 +17,12 @@ model_urls = {
     'resnet152': 'https://download.pytorch.org/models/resnet152-b121ed2d.pth',
 }
 
+model_paths = {
+    'resnet50': './initmodel/resnet50_v2.pth',
+    'resnet101': './initmodel/resnet101_v2.pth',
+    'resnet152': './initmodel/resnet152_v2.pth',
+}
+
 
 def conv3x3(in_planes, out_planes, stride=1):
     """3x3 convolution with padding"""
@@ -124,6 +130,8 @@ class ResNet(nn.Module):
         self.avgpool = nn.AvgPool2d(7, stride=1)
         self.fc = nn.Linear(512 * block.expansion, num_classes)
 
+        if self.fc.weight.is_meta:    # meta device (util.weight_store): 权重之后直接赋值, 不初始化
+            return
         for m in self.modules():
             if isinstance(m, nn.Conv2d):
                 nn.init.kaiming_normal_(m.weight, mode='fan_out', nonlinearity='relu')
@@ -200,7 +208,7 @@ def resnet50(pretrained=True, **kwargs):
     model = ResNet(Bottleneck, [3, 4, 6, 3], **kwargs)
     if pretrained:
         # model.load_state_dict(model_zoo.load_url(model_urls['resnet50']))
-        model_path = './initmodel/resnet50_v2.pth'
+        model_path = model_paths['resnet50']
         model.load_state_dict(torch.load(model_path), strict=False)
     return model
 
@@ -214,7 +222,7 @@ def resnet101(pretrained=False, **kwargs):
     model = ResNet(Bottleneck, [3, 4, 23, 3], **kwargs)
     if pretrained:
         # model.load_state_dict(model_zoo.load_url(model_urls['resnet101']))
-        model_path = './initmodel/resnet101_v2.pth'
+        model_path = model_paths['resnet101']
         model.load_state_dict(torch.load(model_path), strict=False)
     return model
 
@@ -228,6 +236,6 @@ def resnet152(pretrained=False, **kwargs):
     model = ResNet(Bottleneck, [3, 8, 36, 3], **kwargs)
     if pretrained:
         # model.load_state_dict(model_zoo.load_url(model_urls['resnet152']))
-        model_path = './initmodel/resnet152_v2.pth'
+        model_path = model_paths['resnet152']
         model.load_state_dict(torch.load(model_path), strict=False)
     return model
@@ -21,6 +21,11 @@ model_urls = {
     'vgg19_bn': 'https://download.pytorch.org/models/vgg19_bn-c79401a0.pth',
 }
 
+model_paths = {
+    'vgg16': './initmodel/vgg16.pth',
+    'vgg16_bn': './initmodel/vgg16_bn.pth',
+}
+
 
 class VGG(nn.Module):
 
@@ -48,6 +53,8 @@ class VGG(nn.Module):
         return x
 
     def _initialize_weights(self):
+        if next(self.parameters()).is_meta:    # meta device (util.weight_store): 权重之后直接赋值, 不初始化
+            return
         for m in self.modules():
             if isinstance(m, nn.Conv2d):
                 nn.init.kaiming_normal_(m.weight, mode='fan_out', nonlinearity='relu')
@@ -147,7 +154,7 @@ def vgg16(pretrained=False, **kwargs):
     model = VGG(make_layers(cfg['D']), **kwargs)
     if pretrained:
         #model.load_state_dict(model_zoo.load_url(model_urls['vgg16_bn']))
-        model_path = './initmodel/vgg16.pth'
+        model_path = model_paths['vgg16']
         model.load_state_dict(torch.load(model_path), strict=False) 
     return model
 
@@ -162,7 +169,7 @@ def vgg16_bn(pretrained=False, **kwargs):
     model = VGG(make_layers(cfg['D'], batch_norm=True), **kwargs)
     if pretrained:
         #model.load_state_dict(model_zoo.load_url(model_urls['vgg16_bn']))
-        model_path = './initmodel/vgg16_bn.pth'
+        model_path = model_paths['vgg16_bn']
         model.load_state_dict(torch.load(model_path), strict=False)        
     return model
 
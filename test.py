@@ -15,12 +15,12 @@ import torch.optim
 import torch.utils.data
 import torch.multiprocessing as mp
 import torch.distributed as dist
-from tensorboardX import SummaryWriter
 
 from model.PFENet import PFENet   
 from util import dataset
-from util import transform, config
-from util.util import AverageMeter, poly_learning_rate, intersectionAndUnionGPU
+from util import transform, config, weight_store
+from util.util import AverageMeter, IntersectionAndUnionMeter, poly_learning_rate, atomic_save, \
+    get_amp_dtype, amp_autocast, cast_backbone
 
 cv2.ocl.setUseOpenCL(False)
 cv2.setNumThreads(0)
@@ -82,6 +82,8 @@ def main():
     if args.multiprocessing_distributed:
         args.world_size = args.ngpus_per_node * args.world_size
         mp.spawn(main_worker, nprocs=args.ngpus_per_node, args=(args.ngpus_per_node, args))
+    elif args.get('eval_shards', 1) > 1:
+        main_sharded(args)
     else:
         main_worker(args.train_gpu, args.ngpus_per_node, args)
 
@@ -90,33 +92,177 @@ def main_worker(gpu, ngpus_per_node, argss):
     global args
     args = argss
 
-    BatchNorm = nn.BatchNorm2d
+    global logger, writer, device
+    logger = get_logger()
+    writer = None     # test.py 不写 tensorboard
+    device = torch.device("cuda:0" if args.cuda else "cpu")
 
     criterion = nn.CrossEntropyLoss(ignore_index=args.ignore_label)
+    model = get_model()
+    ckpt_path = get_eval_ckpt()
+    eval_state = load_eval_state(ckpt_path)
+    val_loader = get_val_loader(start=eval_state['cursor'] if eval_state else 0)
+    loss_val, mIoU_val, mAcc_val, allAcc_val, class_miou = validate(val_loader, model, criterion, ckpt_path, eval_state) 
+
 
-    model = PFENet(layers=args.layers, classes=2, zoom_factor=8, \
-        criterion=nn.CrossEntropyLoss(ignore_index=255), BatchNorm=BatchNorm, \
-        pretrained=True, shot=args.shot, ppm_scales=args.ppm_scales, vgg=args.vgg)
+def main_sharded(argss):
+    # 将 episode list 分成 eval_shards 份, 每个进程评测一份, 最后把各进程的 intersection/union 计数相加
+    global args
+    args = argss
+    assert args.get('episode_list'), 'sharded evaluation needs a fixed episode_list (see gen_episodes.py)'
+    global logger
+    logger = get_logger()
+    shard_num = args.eval_shards
+    logger.info('=> evaluating {} with {} shards'.format(args.episode_list, shard_num))
+
+    start_time = time.time()
+    result_queue = mp.get_context('spawn').Queue()
+    context = mp.spawn(eval_shard, nprocs=shard_num, args=(args, result_queue), join=False)
+    results = []
+    while not context.join(timeout=5):
+        while not result_queue.empty():
+            results.append(result_queue.get())
+    while len(results) < shard_num:
+        results.append(result_queue.get())
+
+    meters = get_meters()
+    loss_meter = AverageMeter()
+    for shard_id, shard_states, loss_sum, loss_count in sorted(results, key=lambda x: x[0]):
+        for name, meter in meters.items():
+            shard_meter = IntersectionAndUnionMeter(meter.classes, meter.split_gap, meter.ignore_index)
+            shard_meter.load_state_dict(shard_states[name])
+            meter.merge(shard_meter)
+        loss_meter.sum += loss_sum
+        loss_meter.count += loss_count
+    loss_meter.avg = loss_meter.sum / max(loss_meter.count, 1)
+    logger.info('=> {} episodes evaluated in {:.1f}s'.format(loss_meter.count, time.time() - start_time))
+    return report(meters, loss_meter)
+
+
+def eval_shard(shard_id, argss, result_queue):
+    global args
+    args = argss
 
-    global logger, writer
+    global logger, writer, device
     logger = get_logger()
-    writer = SummaryWriter(args.save_path)
+    writer = None
+    shard_num = args.eval_shards
+    if args.cuda:
+        device = torch.device("cuda:{}".format(shard_id % torch.cuda.device_count()))
+    else:
+        device = torch.device("cpu")
+        torch.set_num_threads(max(1, dataset.available_cpus() // shard_num))   # 避免各进程抢占同一批 cpu core
+
+    criterion = nn.CrossEntropyLoss(ignore_index=args.ignore_label)
+    model = get_model()
+    ckpt_path = get_eval_ckpt(shard_id, shard_num)
+    eval_state = load_eval_state(ckpt_path)
+    val_loader = get_val_loader(shard_id, shard_num, start=eval_state['cursor'] if eval_state else 0)
+    meters, loss_meter = evaluate(val_loader, model, criterion, ckpt_path, eval_state)
+    # 队列里的 tensor 通过共享内存传递, 进程退出后就无法读取, 所以传 numpy 计数
+    shard_states = {name: {'confusion': meter.confusion.cpu().numpy(), 'count': meter.count} for name, meter in meters.items()}
+    result_queue.put((shard_id, shard_states, loss_meter.sum, loss_meter.count))
+
+
+def get_eval_ckpt(shard_id=0, shard_num=1):
+    # 评测中间状态 (meter 计数 + episode cursor) 的保存路径, 每个 shard 一个文件
+    if not args.get('eval_ckpt'):
+        return None
+    assert args.get('episode_list'), 'resumable evaluation needs a fixed episode_list (see gen_episodes.py)'
+    if shard_num > 1:
+        return '{}.shard{}'.format(args.eval_ckpt, shard_id)
+    return args.eval_ckpt
+
+
+def get_eval_key():
+    # 只有同一个 episode list / weight / shard 划分下保存的状态才能接着评测
+    return [args.episode_list, args.weight or '', args.get('eval_shards', 1), args.shot, get_variants()]
+
+
+def load_eval_state(ckpt_path):
+    if ckpt_path is None or not os.path.isfile(ckpt_path):
+        return None
+    eval_state = torch.load(ckpt_path)
+    if eval_state['key'] != get_eval_key():
+        raise (RuntimeError("Evaluation state {} was saved for {}, not {}. Remove it to start over.\n".format(
+            ckpt_path, eval_state['key'], get_eval_key())))
+    logger.info("=> resuming evaluation from '{}' ({} episodes done)".format(ckpt_path, eval_state['cursor']))
+    return eval_state
+
+
+def save_eval_state(ckpt_path, meters, loss_meter, cursor):
+    atomic_save({'key': get_eval_key(), 'meters': {name: meter.state_dict() for name, meter in meters.items()}, 'loss_sum': loss_meter.sum,
+                 'loss_count': loss_meter.count, 'cursor': cursor}, ckpt_path)
+
+
+def get_model():
+    BatchNorm = nn.BatchNorm2d
+
+    def build(pretrained):
+        return PFENet(layers=args.layers, classes=2, zoom_factor=8, \
+            criterion=nn.CrossEntropyLoss(ignore_index=255), BatchNorm=BatchNorm, \
+            pretrained=pretrained, shot=args.shot, ppm_scales=args.ppm_scales, vgg=args.vgg)
+
     logger.info("=> creating model ...")
+    if args.weight and os.path.isfile(args.weight):
+        # 不随机初始化, 直接用 mmap 的 weight (head-only 时加上 initmodel 的 backbone) 构建
+        logger.info("=> loading weight '{}'".format(args.weight))
+        model = weight_store.build_model(lambda: build(False), args.weight)
+        logger.info("=> loaded weight '{}'".format(args.weight))
+    else:
+        model = build(True)
+        if args.weight:
+            logger.info("=> no weight found at '{}'".format(args.weight))
     logger.info("Classes: {}".format(args.classes))
     logger.info(model)
     print(args)
 
-    model = torch.nn.DataParallel(model.cuda())
-
-    if args.weight:
-        if os.path.isfile(args.weight):
-            logger.info("=> loading weight '{}'".format(args.weight))
-            checkpoint = torch.load(args.weight)
-            model.load_state_dict(checkpoint['state_dict'])
-            logger.info("=> loaded weight '{}'".format(args.weight))
+    global amp_dtype        # 混合精度: use_apex + opt_level (O1: autocast, O2/O3: backbone 也转为低精度)
+    amp_dtype = get_amp_dtype(args, device)
+    if amp_dtype is not None:
+        cast_backbone(model, amp_dtype, args.opt_level, args.get('keep_batchnorm_fp32', None))
+        logger.info("=> mixed precision: {} {}".format(args.opt_level, amp_dtype))
+    return model.to(device)
+
+
+def get_variants():
+    # ori: 原始 support; avg_prob: 原始/增强 support 分别预测后平均 softmax; multi_shot: 原始+增强 support 一起当作 2*shot 预测
+    variants = list(args.get('eval_variants', None) or ['ori'])
+    for name in variants:
+        assert name in ['ori', 'avg_prob', 'multi_shot'], 'unknown eval variant: {}'.format(name)
+    return variants
+
+
+def get_meters():
+    split_gap = 20 if args.use_coco else 5
+    return {name: IntersectionAndUnionMeter(args.classes, split_gap, args.ignore_label) for name in get_variants()}
+
+
+def predict_variants(model, input, s_input, s_mask, variants, size, s_valid=None):
+    # query 和每张 support 的 backbone 只跑一次, 各 variant 只重新跑 decoder
+    # 返回 {variant: logit/prob} 以及原始 support 的 logit (用于计算 loss)
+    # s_input 的排列为 [orig_1..orig_shot, aug_1..aug_shot] (见 SemData.get_episode)
+    view_num = s_input.size(1)
+    ori = tuple(range(args.shot))
+    aug = tuple(range(args.shot, view_num)) if view_num > args.shot else ori
+    if s_valid is not None and not bool(s_valid[:, list(aug)].all()):    # aug support 被 episode_collate 补齐, 退回 ori
+        aug = ori
+    subsets = {'ori': [ori], 'avg_prob': [ori] if aug == ori else [ori, aug], 'multi_shot': [tuple(range(view_num))]}
+    support_sets = sorted(set([ori] + [sub for name in variants for sub in subsets[name]]))
+    with amp_autocast(device, amp_dtype):
+        logits = model.forward_variants(input, s_input, s_mask, support_sets, s_valid=s_valid)
+    logits = {sub: F.interpolate(logit.float(), size=size, mode='bilinear', align_corners=True) for sub, logit in zip(support_sets, logits)}
+
+    outputs = {}
+    for name in variants:
+        if name == 'avg_prob':
+            outputs[name] = torch.stack([F.softmax(logits[sub], dim=1) for sub in subsets[name]], 0).mean(0)
         else:
-            logger.info("=> no weight found at '{}'".format(args.weight))
+            outputs[name] = logits[subsets[name][0]]
+    return outputs, logits[ori]
+
 
+def get_val_loader(shard_id=0, shard_num=1, start=0):
     value_scale = 255
     mean = [0.485, 0.456, 0.406]
     mean = [item * value_scale for item in mean]
@@ -135,30 +281,46 @@ def main_worker(gpu, ngpus_per_node, argss):
             transform.test_Resize(size=args.val_size),
             transform.ToTensor(),
             transform.Normalize(mean=mean, std=std)])           
-    val_data = dataset.SemData(split=args.split, shot=args.shot, data_root=args.data_root, \
-                            data_list=args.val_list, transform=val_transform, mode='val', \
-                            use_coco=args.use_coco, use_split_coco=args.use_split_coco, args=args)
+    if args.get('episode_list'):
+        val_data = dataset.EpisodeDataset(split=args.split, shot=args.shot, data_root=args.data_root, \
+                                episode_list=args.episode_list, transform=val_transform, mode='val', \
+                                use_coco=args.use_coco, use_split_coco=args.use_split_coco, args=args)
+    else:
+        val_data = dataset.SemData(split=args.split, shot=args.shot, data_root=args.data_root, \
+                                data_list=args.val_list, transform=val_transform, mode='val', \
+                                use_coco=args.use_coco, use_split_coco=args.use_split_coco, args=args)
+    if shard_num > 1 or start > 0:     # 当前 shard 的 episodes, 跳过已经评测过的 start 个
+        val_data = torch.utils.data.Subset(val_data, list(range(shard_id, len(val_data), shard_num))[start:])
     val_sampler = None
-    val_loader = torch.utils.data.DataLoader(val_data, batch_size=args.batch_size_val, shuffle=False, num_workers=args.workers, pin_memory=True, sampler=val_sampler)
+    val_loader = torch.utils.data.DataLoader(val_data, batch_size=args.batch_size_val, shuffle=False, num_workers=args.workers // shard_num,
+                                             pin_memory=args.cuda, sampler=val_sampler, collate_fn=dataset.episode_collate)
+    if args.get('prefetch', 2) > 0:      # 后台线程提前准备 (并拷贝到 gpu) 之后的 episode
+        val_loader = dataset.PrefetchLoader(val_loader, device, args.get('prefetch', 2))
+    return val_loader
+
+
+def validate(val_loader, model, criterion, ckpt_path=None, eval_state=None):
+    meters, loss_meter = evaluate(val_loader, model, criterion, ckpt_path, eval_state)
+    return report(meters, loss_meter)
 
-    loss_val, mIoU_val, mAcc_val, allAcc_val, class_miou = validate(val_loader, model, criterion) 
 
-def validate(val_loader, model, criterion):
+def evaluate(val_loader, model, criterion, ckpt_path=None, eval_state=None):
     if main_process():
         logger.info('>>>>>>>>>>>>>>>> Start Evaluation >>>>>>>>>>>>>>>>')
     batch_time = AverageMeter()
     model_time = AverageMeter()
     data_time = AverageMeter()
     loss_meter = AverageMeter()
-    intersection_meter = AverageMeter()
-    union_meter = AverageMeter()
-    target_meter = AverageMeter()
-    if args.use_coco:
-        split_gap = 20
-    else:
-        split_gap = 5
-    class_intersection_meter = [0]*split_gap
-    class_union_meter = [0]*split_gap  
+    variants = get_variants()
+    meters = get_meters()
+    start = 0
+    if eval_state is not None:
+        for name, meter in meters.items():
+            meter.load_state_dict(eval_state['meters'][name])
+        loss_meter.sum, loss_meter.count = eval_state['loss_sum'], eval_state['loss_count']
+        loss_meter.avg = loss_meter.sum / max(loss_meter.count, 1)
+        start = eval_state['cursor']
+    ckpt_freq = args.get('eval_ckpt_freq', 500)
 
     if args.manual_seed is not None and args.fix_random_seed_val:
         torch.cuda.manual_seed(args.manual_seed)
@@ -169,57 +331,74 @@ def validate(val_loader, model, criterion):
 
     model.eval()
     end = time.time()
-    if args.split != 999:
+    if args.get('episode_list'):
+        test_num = start + len(val_loader.dataset)   # fixed episodes, a single pass over the list
+        epoch_num = 1
+    elif args.split != 999:
         if args.use_coco:
             test_num = 5000
         else:
             test_num = 5000 
+        epoch_num = 20
     else:
         test_num = len(val_loader)
+        epoch_num = 20
     assert test_num % args.batch_size_val == 0    
-    iter_num = 0
-    total_time = 0
-    for e in range(20):
-        for i, (input, target, s_input, s_mask, subcls, ori_label) in enumerate(val_loader):
+    iter_num = start // args.batch_size_val
+    # loss 留在 device 上累加, 只在保存评测状态/输出 log/结束时读取
+    loss_sum, loss_count = torch.tensor(float(loss_meter.sum), dtype=torch.float64, device=device), loss_meter.count
+
+    def sync_loss():
+        loss_meter.sum, loss_meter.count = loss_sum.item(), loss_count
+        loss_meter.avg = loss_meter.sum / max(loss_meter.count, 1)
+
+    for e in range(epoch_num):
+        for i, (input, target, s_input, s_mask, subcls, ori_label, s_valid) in enumerate(val_loader):
             if (iter_num-1) * args.batch_size_val >= test_num:
                 break
             iter_num += 1    
             data_time.update(time.time() - end)
-            input = input.cuda(non_blocking=True)
-            target = target.cuda(non_blocking=True)
-            ori_label = ori_label.cuda(non_blocking=True)
-            start_time = time.time()
-            output = model(s_x=s_input, s_y=s_mask, x=input, y=target)
-            total_time = total_time + 1
-            model_time.update(time.time() - start_time)
-
+            if device.type == 'cuda':
+                input = input.to(device, non_blocking=True)
+                target = target.to(device, non_blocking=True)
+                ori_label = ori_label.to(device, non_blocking=True)
+                s_input = s_input.to(device, non_blocking=True)
+                s_mask = s_mask.to(device, non_blocking=True)
+                if s_valid is not None:
+                    s_valid = s_valid.to(device, non_blocking=True)
             if args.ori_resize:
                 longerside = max(ori_label.size(1), ori_label.size(2))
-                backmask = torch.ones(ori_label.size(0), longerside, longerside).cuda()*255
+                backmask = torch.ones(ori_label.size(0), longerside, longerside, device=device)*255
                 backmask[0, :ori_label.size(1), :ori_label.size(2)] = ori_label
                 target = backmask.clone().long()
 
-            output = F.interpolate(output, size=target.size()[1:], mode='bilinear', align_corners=True)         
+            start_time = time.time()
+            with torch.no_grad():
+                outputs, output = predict_variants(model, input, s_input, s_mask, variants, target.size()[1:], s_valid)
+            model_time.update(time.time() - start_time)
+
             loss = criterion(output, target)    
 
             n = input.size(0)
             loss = torch.mean(loss)
 
-            output = output.max(1)[1]
-
-            intersection, union, new_target = intersectionAndUnionGPU(output, target, args.classes, args.ignore_label)
-            intersection, union, target, new_target = intersection.cpu().numpy(), union.cpu().numpy(), target.cpu().numpy(), new_target.cpu().numpy()
-            intersection_meter.update(intersection), union_meter.update(union), target_meter.update(new_target)
-                
             subcls = subcls[0].cpu().numpy()[0]
-            class_intersection_meter[(subcls-1)%split_gap] += intersection[1]
-            class_union_meter[(subcls-1)%split_gap] += union[1] 
-
-            accuracy = sum(intersection_meter.val) / (sum(target_meter.val) + 1e-10)
-            loss_meter.update(loss.item(), input.size(0))
+            for name in variants:
+                step = meters[name].update(outputs[name].max(1)[1], target, subcls)    # 计数留在 device 上, 不同步
+                if name == variants[0]:
+                    intersection, union, new_target = step
+
+            loss_sum += loss.detach().double() * n
+            loss_count += n
+            if ckpt_path is not None and iter_num % ckpt_freq == 0:
+                sync_loss()
+                save_eval_state(ckpt_path, meters, loss_meter, iter_num * args.batch_size_val)
             batch_time.update(time.time() - end)
             end = time.time()
             if ((i + 1) % (test_num/100) == 0) and main_process():
+                accuracy = intersection.sum().item() / (new_target.sum().item() + 1e-10)
+                sync_loss()
+                loss_meter.val = loss.item()
                 logger.info('Test: [{}/{}] '
                             'Data {data_time.val:.3f} ({data_time.avg:.3f}) '
                             'Batch {batch_time.val:.3f} ({batch_time.avg:.3f}) '
@@ -230,33 +409,32 @@ def validate(val_loader, model, criterion):
                                                               loss_meter=loss_meter,
                                                               accuracy=accuracy))
 
-    iou_class = intersection_meter.sum / (union_meter.sum + 1e-10)
-    accuracy_class = intersection_meter.sum / (target_meter.sum + 1e-10)
-    mIoU = np.mean(iou_class)
-    mAcc = np.mean(accuracy_class)
-    allAcc = sum(intersection_meter.sum) / (sum(target_meter.sum) + 1e-10)
-
-    
-    class_iou_class = []
-    class_miou = 0
-    for i in range(len(class_intersection_meter)):
-        class_iou = class_intersection_meter[i]/(class_union_meter[i]+ 1e-10)
-        class_iou_class.append(class_iou)
-        class_miou += class_iou
-    class_miou = class_miou*1.0 / len(class_intersection_meter)
-    logger.info('meanIoU---Val result: mIoU {:.4f}.'.format(class_miou))
-    for i in range(split_gap):
-        logger.info('Class_{} Result: iou {:.4f}.'.format(i+1, class_iou_class[i]))            
-    
-
+    sync_loss()
+    if ckpt_path is not None:
+        save_eval_state(ckpt_path, meters, loss_meter, iter_num * args.batch_size_val)
+    print('avg inference time: {:.4f}, count: {}'.format(model_time.avg, test_num))
+    return meters, loss_meter
+
+
+def report(meters, loss_meter):
+    # 每个 variant 分别输出结果, 返回第一个 variant 的结果
+    results = None
+    for name, meter in meters.items():
+        tag = '[{}] '.format(name) if len(meters) > 1 else ''
+        mIoU, mAcc, allAcc, class_miou, iou_class, accuracy_class, class_iou_class = meter.get_results()
+        logger.info('{}meanIoU---Val result: mIoU {:.4f}.'.format(tag, class_miou))
+        for i in range(meter.split_gap):
+            logger.info('{}Class_{} Result: iou {:.4f}.'.format(tag, i+1, class_iou_class[i]))            
+
+        if main_process():
+            logger.info('{}FBIoU---Val result: mIoU/mAcc/allAcc {:.4f}/{:.4f}/{:.4f}.'.format(tag, mIoU, mAcc, allAcc))
+            for i in range(args.classes):
+                logger.info('{}Class_{} Result: iou/accuracy {:.4f}/{:.4f}.'.format(tag, i, iou_class[i], accuracy_class[i]))
+        if results is None:
+            results = (loss_meter.avg, mIoU, mAcc, allAcc, class_miou)
     if main_process():
-        logger.info('FBIoU---Val result: mIoU/mAcc/allAcc {:.4f}/{:.4f}/{:.4f}.'.format(mIoU, mAcc, allAcc))
-        for i in range(args.classes):
-            logger.info('Class_{} Result: iou/accuracy {:.4f}/{:.4f}.'.format(i, iou_class[i], accuracy_class[i]))
         logger.info('<<<<<<<<<<<<<<<<< End Evaluation <<<<<<<<<<<<<<<<<')
-
-    print('avg inference time: {:.4f}, count: {}'.format(model_time.avg, test_num))
-    return loss_meter.avg, mIoU, mAcc, allAcc, class_miou
+    return results
 
 
 if __name__ == '__main__':
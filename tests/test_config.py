@@ -0,0 +1,33 @@
+import glob
+import os
+
+from util import config
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_dump_cfg_round_trip(tmp_path):
+    cfg_files = sorted(glob.glob(os.path.join(ROOT, 'config', '*', '*.yaml')))
+    assert len(cfg_files) > 0
+    for cfg_file in cfg_files:
+        cfg = config.load_cfg_from_cfg_file(cfg_file)
+        dumped = str(tmp_path / 'config.yaml')
+        config.dump_cfg(cfg, dumped)
+        assert config.load_cfg_from_cfg_file(dumped) == cfg, cfg_file
+
+
+class Device(object):
+    def __str__(self):
+        return 'cpu'
+
+
+def test_dump_cfg_types(tmp_path):
+    # tuple 写成 list, yaml 不能表示的值写成 str
+    cfg = config.CfgNode({'train_gpu': (0, 1), 'base_lr': 0.0025, 'resume': None, 'use_coco': False,
+                          'save_path': 'exp/pascal', 'device': Device()})
+    dumped = str(tmp_path / 'config.yaml')
+    config.dump_cfg(cfg, dumped)
+    loaded = config.load_cfg_from_cfg_file(dumped)
+    assert loaded == dict(cfg, train_gpu=[0, 1], device='cpu')
+    # 命令行的覆盖对读回的配置同样适用
+    assert config.merge_cfg_from_list(loaded, ['base_lr', '0.01']).base_lr == 0.01
@@ -0,0 +1,136 @@
+import types
+
+import pytest
+
+from util import dataset
+
+
+def make_data(num=40, classes=(1, 2, 3, 4), shot=2):
+    # 第 k 张图片属于 class classes[k % len(classes)]
+    items = [('img/{:03d}.jpg'.format(k), 'lbl/{:03d}.png'.format(k)) for k in range(num)]
+    sub_class_file_list = {c: dataset.IndexedList(items, range(i, num, len(classes))) for i, c in enumerate(classes)}
+    return types.SimpleNamespace(data_list=items, sub_class_file_list=sub_class_file_list, shot=shot)
+
+
+def class_files(data, c):
+    return set(data.sub_class_file_list[c].indices.tolist())
+
+
+def test_episode_sampler_deterministic():
+    data = make_data()
+    sampler = dataset.EpisodeSampler(data, episode_num=50, seed=3)
+    episodes = list(sampler)
+    assert len(episodes) == len(sampler) == 50
+    assert list(dataset.EpisodeSampler(data, episode_num=50, seed=3)) == episodes
+    sampler.set_epoch(1)
+    assert list(sampler) != episodes
+    sampler.set_epoch(0)
+    assert list(sampler) == episodes
+    assert list(dataset.EpisodeSampler(data, episode_num=50, seed=4)) != episodes
+
+
+def test_episode_sampler_episodes():
+    data = make_data(shot=3)
+    for episode in dataset.EpisodeSampler(data, episode_num=200, seed=0):
+        query, c, supports = episode[:3]
+        files = class_files(data, c)
+        assert query in files and set(supports) <= files
+        assert query not in supports and len(set(supports)) == data.shot
+
+
+def test_episode_sampler_class_rounds():
+    data = make_data()
+    classes = [episode[1] for episode in dataset.EpisodeSampler(data, episode_num=40, seed=0)]
+    for k in range(0, 40, 4):
+        assert sorted(classes[k:k + 4]) == [1, 2, 3, 4]
+
+
+def test_make_episodes(monkeypatch):
+    data = make_data(shot=5)
+    data.get_label_class = lambda label: [1, 2, 3, 4]
+    monkeypatch.setattr(dataset.cv2, 'imread', lambda *args: None)
+    episodes = dataset.make_episodes(data, 100, seed=0)
+    assert episodes == dataset.make_episodes(data, 100, seed=0)
+    for k, (image_path, label_path, c, supports) in enumerate(episodes):
+        assert (image_path, label_path) == data.data_list[k % len(data.data_list)]
+        assert (image_path, label_path) not in supports and len(set(supports)) == data.shot
+        assert set(supports) <= set(data.sub_class_file_list[c])
+
+
+def test_make_episodes_all_other_supports(monkeypatch):
+    # shot = 类中图片数 - 1: support 必须正好是 query 以外的所有图片
+    data = make_data(num=6, classes=(1,), shot=5)
+    data.get_label_class = lambda label: [1]
+    monkeypatch.setattr(dataset.cv2, 'imread', lambda *args: None)
+    for image_path, label_path, c, supports in dataset.make_episodes(data, 12, seed=1):
+        assert sorted(supports) == sorted(item for item in data.data_list if item != (image_path, label_path))
+    data.shot = 6
+    with pytest.raises(RuntimeError):
+        dataset.make_episodes(data, 1)
+
+
+def test_episodes_round_trip(tmp_path):
+    episodes = [('/data/img/001.jpg', '/data/lbl/001.png', 3, [('/data/img/002.jpg', '/data/lbl/002.png')]),
+                ('/data/img/004.jpg', '/data/lbl/004.png', 12, [('/data/img/005.jpg', '/data/lbl/005.png'),
+                                                                 ('/data/img/006.jpg', '/data/lbl/006.png')])]
+    episode_list = str(tmp_path / 'episodes.txt')
+    dataset.save_episodes(episodes, episode_list, data_root='/data')
+    assert open(episode_list).readline().split()[:3] == ['img/001.jpg', 'lbl/001.png', '3']
+    assert dataset.load_episodes(episode_list, data_root='/data') == episodes
+    assert dataset.load_episodes(episode_list)[0][0] == 'img/001.jpg'
+
+
+def test_episode_sampler_resume():
+    data = make_data()
+    sampler = dataset.EpisodeSampler(data, episode_num=30, seed=1)
+    sampler.set_epoch(2)
+    episodes = list(sampler)
+    resumed = dataset.EpisodeSampler(data, episode_num=30, seed=1)
+    resumed.load_state_dict({'seed': 1, 'epoch': 2, 'start': 12})
+    assert list(resumed) == episodes[12:]
+    resumed.set_epoch(3)
+    assert len(list(resumed)) == 30
+
+
+def test_episode_sampler_sharding():
+    data = make_data()
+    episodes = list(dataset.EpisodeSampler(data, episode_num=30, seed=1))
+    shards = [dataset.EpisodeSampler(data, episode_num=30, seed=1, num_replicas=3, rank=r) for r in range(3)]
+    assert [len(s) for s in shards] == [10, 10, 10]
+    for r, shard in enumerate(shards):
+        assert list(shard) == episodes[r::3]
+    # 每个 rank 的 start 按本 rank 的 episode 计数
+    shards[1].load_state_dict({'seed': 1, 'epoch': 0, 'start': 4})
+    assert list(shards[1]) == episodes[1::3][4:]
+
+
+def test_seeded_sampler_shuffle():
+    sampler = dataset.SeededSampler(range(20), seed=5, shuffle=True)
+    items = list(sampler)
+    assert sorted(index for index, _ in items) == list(range(20)) and [index for index, _ in items] != list(range(20))
+    assert list(dataset.SeededSampler(range(20), seed=5, shuffle=True)) == items
+    # 每个 episode 的 seed 与不 shuffle 时相同位置的一样, 只有顺序由 (seed, epoch) 决定
+    assert [seed for _, seed in items] == [seed for _, seed in dataset.SeededSampler(range(20), seed=5)]
+    sampler.set_epoch(1)
+    assert list(sampler) != items
+    sampler.set_epoch(0)
+    assert list(sampler) == items
+
+
+def test_seeded_sampler_sharding():
+    items = list(dataset.SeededSampler(range(21), seed=2, num=20, shuffle=True))
+    shards = [dataset.SeededSampler(range(21), seed=2, num=20, rank=r, world_size=4, shuffle=True) for r in range(4)]
+    assert [len(s) for s in shards] == [5, 5, 5, 5]
+    for r, shard in enumerate(shards):
+        assert list(shard) == items[r::4]
+
+
+def test_seeded_sampler_resume():
+    sampler = dataset.SeededSampler(range(21), seed=2, num=20, rank=1, world_size=2, shuffle=True)
+    sampler.set_epoch(3)
+    items = list(sampler)
+    resumed = dataset.SeededSampler(range(21), seed=2, num=20, rank=1, world_size=2, shuffle=True)
+    resumed.load_state_dict(dict(sampler.state_dict(), start=4))
+    assert list(resumed) == items[4:]
+    resumed.set_epoch(4)
+    assert len(list(resumed)) == 10
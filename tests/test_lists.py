@@ -0,0 +1,66 @@
+import sys
+
+import pytest
+
+import make_lists
+from util import lists
+
+
+def write(path, lines):
+    path.write_text(''.join(line + '\n' for line in lines))
+    return str(path)
+
+
+def test_read_list(tmp_path):
+    data_list = write(tmp_path / 'a.txt', ['img/1.jpg lbl/1.png', '', 'img/2.jpg lbl/2.png'])
+    assert list(lists.read_list(data_list)) == [('img/1.jpg', 'lbl/1.png'), ('img/2.jpg', 'lbl/2.png')]
+    with pytest.raises(RuntimeError):
+        list(lists.read_list(write(tmp_path / 'b.txt', ['img/1.jpg'])))
+    with pytest.raises(RuntimeError):
+        list(lists.read_list(str(tmp_path / 'missing.txt')))
+
+
+def test_unique():
+    pairs = [('a', '1'), ('b', '2'), ('a', '1'), ('a', '2'), ('b', '2')]
+    assert list(lists.unique(pairs)) == [('a', '1'), ('b', '2'), ('a', '2')]
+
+
+def test_merge(tmp_path):
+    first = write(tmp_path / 'voc.txt', ['img/1.jpg lbl/1.png', 'img/2.jpg lbl/2.png'])
+    second = write(tmp_path / 'sbd.txt', ['img/2.jpg lbl/2.png', 'img/3.jpg lbl/3.png', 'img/1.jpg lbl/1.png'])
+    merged = str(tmp_path / 'merged.txt')
+    assert lists.write_list(lists.merge([first, second]), merged) == 3
+    assert open(merged).read().split('\n') == ['img/1.jpg lbl/1.png', 'img/2.jpg lbl/2.png', 'img/3.jpg lbl/3.png', '']
+
+
+def test_make_lists_merge(tmp_path, monkeypatch, capsys):
+    first = write(tmp_path / 'voc.txt', ['img/1.jpg lbl/1.png', 'img/2.jpg lbl/2.png'])
+    second = write(tmp_path / 'sbd.txt', ['img/2.jpg lbl/2.png', 'img/3.jpg lbl/3.png'])
+    merged = str(tmp_path / 'merged.txt')
+    monkeypatch.setattr(sys, 'argv', ['make_lists.py', 'merge', first, second, '--output', merged])
+    make_lists.main()
+    assert capsys.readouterr().out == 'Ori: 4, new: 3\n'
+    assert list(lists.read_list(merged)) == list(lists.merge([first, second]))
+
+
+def test_split(tmp_path):
+    pairs = [('img/{}.jpg'.format(k), 'lbl/{}.png'.format(k)) for k in range(1000)]
+    train_list, val_list = str(tmp_path / 'train.txt'), str(tmp_path / 'val.txt')
+    train_num, val_num = lists.split(pairs, train_list, val_list, 0.2, seed=1)
+    train, val = list(lists.read_list(train_list)), list(lists.read_list(val_list))
+    assert (len(train), len(val)) == (train_num, val_num) and 150 < val_num < 250
+    assert sorted(train + val) == sorted(pairs)
+    # 与行的顺序和其它行无关
+    lists.split(pairs[::-1][:500], str(tmp_path / 'train2.txt'), str(tmp_path / 'val2.txt'), 0.2, seed=1)
+    assert set(lists.read_list(str(tmp_path / 'val2.txt'))) == set(val) & set(pairs[500:])
+    lists.split(pairs, str(tmp_path / 'train3.txt'), str(tmp_path / 'val3.txt'), 0.2, seed=2)
+    assert list(lists.read_list(str(tmp_path / 'val3.txt'))) != val
+
+
+def test_missing_files(tmp_path):
+    (tmp_path / 'img').mkdir()
+    (tmp_path / 'img' / '1.jpg').write_text('')
+    (tmp_path / 'lbl').mkdir()
+    (tmp_path / 'lbl' / '1.png').write_text('')
+    pairs = [('img/1.jpg', 'lbl/1.png'), ('img/2.jpg', 'lbl/1.png'), ('img/1.jpg', 'lbl/3.png')]
+    assert list(lists.missing_files(pairs, str(tmp_path))) == [(1, 'img/2.jpg'), (2, 'lbl/3.png')]
@@ -0,0 +1,189 @@
+import os
+import contextlib
+
+import numpy as np
+import pytest
+import torch
+from torch.utils._python_dispatch import TorchDispatchMode
+
+from util.util import IntersectionAndUnionMeter, TrainMeter, intersectionAndUnionGPU, atomic_save, \
+    CheckpointWriter
+
+
+def random_episode(gen, size=(2, 17, 19)):
+    output = torch.randint(0, 2, size, generator=gen)
+    target = torch.randint(0, 2, size, generator=gen)
+    target[torch.rand(size, generator=gen) < 0.1] = 255
+    return output, target
+
+
+class HostTransfers(TorchDispatchMode):
+    # 记录在 host 和 device 之间拷贝数据的 op (在 cuda 上会同步 stream): 由 host 数据建 tensor, 读回 host, 跨 device 拷贝
+    def __init__(self):
+        super(HostTransfers, self).__init__()
+        self.ops = []
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        kwargs = kwargs or {}
+        name = func.overloadpacket.__name__
+        out = func(*args, **kwargs)
+        if name in ('lift_fresh', '_local_scalar_dense'):
+            self.ops.append(name)
+        elif name in ('_to_copy', 'copy_') and torch.is_tensor(out) and out.device != args[-1 if name == 'copy_' else 0].device:
+            self.ops.append(name)
+        return out
+
+
+def devices():
+    return ['cpu'] + (['cuda'] if torch.cuda.is_available() else [])
+
+
+@contextlib.contextmanager
+def no_host_transfers(device):
+    # cuda 上 stream 同步直接报错; 所有 device 上都检查 HostTransfers
+    if device == 'cuda':
+        torch.cuda.set_sync_debug_mode('error')
+    try:
+        with HostTransfers() as transfers:
+            yield
+    finally:
+        if device == 'cuda':
+            torch.cuda.set_sync_debug_mode('default')
+    assert transfers.ops == []
+
+
+@pytest.mark.parametrize('device', devices())
+def test_meter_update_stays_on_device(device):
+    gen = torch.Generator().manual_seed(4)
+    meter = IntersectionAndUnionMeter()
+    episodes = [tuple(t.to(device) for t in random_episode(gen)) for _ in range(3)]
+    meter.update(episodes[0][0], episodes[0][1], 1)    # 第一次 update 把 confusion 移到 device 上
+    with no_host_transfers(device):
+        for k, (output, target) in enumerate(episodes):
+            meter.update(output, target, np.array([k + 2]))    # subcls 与 validate/evaluate 中一样来自 cpu
+    assert meter.count == 4
+
+
+def test_meter_matches_intersection_and_union():
+    gen = torch.Generator().manual_seed(0)
+    meter = IntersectionAndUnionMeter(classes=2, split_gap=5)
+    total = np.zeros((3, 2))
+    class_total = np.zeros((2, 5))
+    for k in range(12):
+        output, target = random_episode(gen)
+        subcls = k % 5 + 1
+        step = meter.update(output, target, subcls)
+        expected = intersectionAndUnionGPU(output.clone().float(), target.clone().float(), 2, 255)
+        for got, want in zip(step, expected):
+            assert got.device == output.device and got.tolist() == want.long().tolist()
+        total += np.array([t.numpy() for t in expected])
+        class_total[:, subcls - 1] += [expected[0][1].item(), expected[1][1].item()]
+
+    intersection, union, target, class_intersection, class_union = meter.get_counts()
+    assert np.array_equal(np.stack([intersection, union, target]), total)
+    assert np.array_equal(np.stack([class_intersection, class_union]), class_total)
+    mIoU, mAcc, allAcc, class_miou, iou_class, accuracy_class, class_iou_class = meter.get_results()
+    assert np.allclose(iou_class, total[0] / total[1]) and np.allclose(accuracy_class, total[0] / total[2])
+    assert np.allclose(class_iou_class, class_total[0] / class_total[1])
+    assert meter.count == 12
+
+
+def test_meter_merge():
+    gen = torch.Generator().manual_seed(1)
+    episodes = [(random_episode(gen), k % 5 + 1) for k in range(10)]
+    single, parts = IntersectionAndUnionMeter(), [IntersectionAndUnionMeter(), IntersectionAndUnionMeter()]
+    for k, ((output, target), subcls) in enumerate(episodes):
+        single.update(output, target, subcls)
+        parts[k % 2].update(output, target, subcls)
+    parts[0].merge(parts[1])
+    assert parts[0].count == single.count
+    for merged, want in zip(parts[0].get_results(), single.get_results()):
+        assert np.array_equal(merged, want)
+
+
+def test_meter_state_dict(tmp_path):
+    # 评测中断后从保存的状态继续, 结果与一次评测完相同
+    gen = torch.Generator().manual_seed(2)
+    episodes = [(random_episode(gen), k % 5 + 1) for k in range(10)]
+    single, first = IntersectionAndUnionMeter(), IntersectionAndUnionMeter()
+    for k, ((output, target), subcls) in enumerate(episodes):
+        single.update(output, target, subcls)
+        if k < 6:
+            first.update(output, target, subcls)
+    filename = str(tmp_path / 'eval_state.pth')
+    atomic_save(first.state_dict(), filename)
+    resumed = IntersectionAndUnionMeter()
+    resumed.load_state_dict(torch.load(filename))
+    for (output, target), subcls in episodes[6:]:
+        resumed.update(output, target, subcls)
+    assert resumed.count == single.count
+    for got, want in zip(resumed.get_results(), single.get_results()):
+        assert np.array_equal(got, want)
+
+
+def test_train_meter():
+    gen = torch.Generator().manual_seed(3)
+    meter = TrainMeter()
+    losses, counts = [], []
+    for k in range(4):
+        output, target = random_episode(gen)
+        loss = torch.rand(3, generator=gen)
+        meter.update(loss[0], loss[1], loss[2], output, target, n=2)
+        losses.append(loss.double())
+        counts.append(intersectionAndUnionGPU(output.clone().float(), target.clone().float(), 2, 255))
+    steps = meter.flush()
+    assert len(steps) == 4 and meter.flush() == []
+    for step, loss, count in zip(steps, losses, counts):
+        assert np.allclose(step[:3], loss.numpy())
+        for got, want in zip(step[3:], count):
+            assert np.array_equal(got, want.numpy())
+    main_loss, aux_loss, loss = meter.get_results()[:3]
+    assert np.allclose([main_loss, aux_loss, loss], torch.stack(losses).mean(0).numpy())
+    total = np.sum([[t.numpy() for t in count] for count in counts], axis=0)
+    assert np.allclose(meter.get_results()[6], total[0] / total[1])
+
+
+@pytest.mark.parametrize('device', devices())
+def test_train_meter_update_stays_on_device(device):
+    gen = torch.Generator().manual_seed(5)
+    meter = TrainMeter()
+    steps = [(torch.rand(3, generator=gen).to(device),) + tuple(t.to(device) for t in random_episode(gen)) for _ in range(3)]
+    loss, output, target = steps[0]
+    meter.update(loss[0], loss[1], loss[2], output, target, n=2)    # 第一次 update 把累加的 tensor 移到 device 上
+    with no_host_transfers(device):
+        for loss, output, target in steps:
+            meter.update(loss[0], loss[1], loss[2], output, target, n=2)
+    assert meter.count == 8 and len(meter.flush()) == 4
+
+
+def test_atomic_save(tmp_path):
+    filename = str(tmp_path / 'ckpt.pth')
+    atomic_save({'epoch': 1, 'w': torch.arange(4)}, filename)
+    atomic_save({'epoch': 2, 'w': torch.arange(3)}, filename)
+    state = torch.load(filename)
+    assert state['epoch'] == 2 and torch.equal(state['w'], torch.arange(3))
+    assert os.listdir(str(tmp_path)) == ['ckpt.pth']
+
+
+def test_checkpoint_writer_retention(tmp_path):
+    def path(name):
+        return str(tmp_path / name)
+
+    writer = CheckpointWriter(keep_best=2, keep_last=2)
+    for epoch, metric in enumerate([0.1, 0.5, 0.3, 0.4, 0.2], 1):
+        writer.save({'epoch': epoch}, path('best_{}.pth'.format(epoch)), kind='best', metric=metric)
+        writer.save({'epoch': epoch}, path('epoch_{}.pth'.format(epoch)), kind='last')
+        writer.save({'epoch': epoch}, path('latest.pth'))
+    writer.close()
+    assert sorted(os.listdir(str(tmp_path))) == ['best_2.pth', 'best_4.pth', 'epoch_4.pth', 'epoch_5.pth', 'latest.pth']
+    assert torch.load(path('latest.pth'))['epoch'] == 5
+
+
+def test_checkpoint_writer_snapshot(tmp_path):
+    # save() 返回后修改 state 不影响写出的文件
+    writer = CheckpointWriter()
+    w = torch.zeros(3)
+    writer.save({'w': w}, str(tmp_path / 'a.pth'))
+    w += 1
+    writer.close()
+    assert torch.equal(torch.load(str(tmp_path / 'a.pth'))['w'], torch.zeros(3))
@@ -1,6 +1,10 @@
 import os
 import random
 import time
+import contextlib
+import collections
+import copy
+import queue
 import cv2
 import numpy as np
 import logging
@@ -15,12 +19,13 @@ import torch.optim
 import torch.utils.data
 import torch.multiprocessing as mp
 import torch.distributed as dist
-from tensorboardX import SummaryWriter
 
 from model.PFENet import PFENet
 from util import dataset
 from util import transform, config
-from util.util import AverageMeter, poly_learning_rate, intersectionAndUnionGPU, intersectionAndUnion
+from util.util import AverageMeter, IntersectionAndUnionMeter, TrainMeter, poly_learning_rate, \
+    get_amp_dtype, amp_autocast, get_grad_scaler, cast_backbone, get_rng_state, set_rng_state, CheckpointWriter, cpu_snapshot, \
+    backbone_hash, head_hash, head_state_dict, load_checkpoint_weights
 
 cv2.ocl.setUseOpenCL(False)
 cv2.setNumThreads(0)
@@ -46,18 +51,128 @@ def get_logger():
     logger.setLevel(logging.INFO)
     handler = logging.StreamHandler()
     fmt = "[%(asctime)s line %(lineno)d %(process)d] %(message)s"
+    if args.distributed:     # 多进程时标出 rank, 非主进程只输出 warning 及以上
+        fmt = "[%(asctime)s line %(lineno)d %(process)d rank {}/{}] %(message)s".format(args.rank, args.world_size)
     handler.setFormatter(logging.Formatter(fmt))
     logger.addHandler(handler)
     return logger
 
 
 
+def main_process():
+    return not args.distributed or args.rank == 0
+
+
+def unwrap(model):
+    return model.module if isinstance(model, nn.parallel.DistributedDataParallel) else model
+
+
 def main():
-    global args
     args = get_parser()
     assert args.classes > 1
     assert args.zoom_factor in [1, 2, 4, 8]
     assert (args.train_h - 1) % 8 == 0 and (args.train_w - 1) % 8 == 0
+    args.loaded_cfg = copy.deepcopy(dict(args))     # 读入的配置 (config 文件 + 命令行), 之后 world_size/batch_size 等会被改成运行时的值
+    # multiprocessing_distributed: 每个节点启动 len(train_gpu) 个进程 (cpu 上即进程数), world_size/rank 为节点数与本节点序号
+    # dist_url 为 env:// 且 world_size/rank 为 -1 时, 进程由 torchrun 等外部启动, 从 WORLD_SIZE/RANK/LOCAL_RANK 读取
+    # DDP 训练, batch_size 为所有进程的总和
+    args.ngpus_per_node = len(args.train_gpu)
+    args.dist_url = args.get('dist_url', 'tcp://127.0.0.1:6789')
+    args.world_size, args.rank = args.get('world_size', 1), args.get('rank', 0)
+    if args.dist_url == "env://" and args.world_size == -1:
+        args.world_size = int(os.environ["WORLD_SIZE"])
+    args.distributed = args.world_size > 1 or args.multiprocessing_distributed
+    if args.multiprocessing_distributed and args.ngpus_per_node == 1 and args.world_size == 1:
+        args.distributed = False
+    if not args.distributed:
+        args.multiprocessing_distributed = False
+    if args.multiprocessing_distributed:
+        args.world_size = args.ngpus_per_node * args.world_size
+        mp.spawn(main_worker, nprocs=args.ngpus_per_node, args=(args.ngpus_per_node, args))
+    else:
+        main_worker(int(os.environ.get("LOCAL_RANK", 0)), args.ngpus_per_node, args)
+
+
+def get_model():
+    BatchNorm = nn.BatchNorm2d
+    model = PFENet(layers=args.layers, classes=2, zoom_factor=8, \
+                   criterion=nn.CrossEntropyLoss(ignore_index=255), BatchNorm=BatchNorm, \
+                   pretrained=True, shot=args.shot, ppm_scales=args.ppm_scales, vgg=args.vgg, \
+                   checkpoint_head=args.get('checkpoint_head', False))   # if arg.vgg=False then use Resnet
+    return model
+
+
+def loader_kwargs():
+    # DataLoader 的 worker 设置; persistent_workers 时 worker 进程 (及其 data_cache_mb 缓存) 在各 epoch 和 validate 间复用
+    kwargs = {'num_workers': args.workers, 'pin_memory': args.cuda}
+    if args.workers > 0:
+        kwargs.update(prefetch_factor=args.get('prefetch_factor', 2), persistent_workers=args.get('persistent_workers', False))
+    return kwargs
+
+
+def get_val_loader():
+    value_scale = 255
+    mean = [0.485, 0.456, 0.406]
+    mean = [item * value_scale for item in mean]
+    std = [0.229, 0.224, 0.225]
+    std = [item * value_scale for item in std]
+    kwargs = loader_kwargs()
+    if args.resized_val:
+        val_transform = transform.Compose([
+            transform.Resize(size=args.val_size),
+            transform.ToTensor(),
+            transform.Normalize(mean=mean, std=std)])
+    else:
+        val_transform = transform.Compose([
+            transform.test_Resize(size=args.val_size),
+            transform.ToTensor(),
+            transform.Normalize(mean=mean, std=std)])
+    # val 数据用 val_list.txt(从val数据中选择），其class从sub_val_list中选择，与训练数据不能重合
+    # validate() 只用原始的 shot 张 support, 不做 TEST_DATA_AUGMENT 的 support augmentation (meta_aug=0), 见 test.py
+    if args.get('episode_list'):    # 用 gen_episodes.py 预先生成的固定 episodes
+        val_data = dataset.EpisodeDataset(split=args.split, shot=args.shot, data_root=args.data_root, \
+                                          episode_list=args.episode_list, transform=val_transform, mode='val', \
+                                          use_coco=args.use_coco, use_split_coco=args.use_split_coco, args=args, meta_aug=0)
+    else:
+        val_data = dataset.SemData(split=args.split, shot=args.shot, data_root=args.data_root, \
+                                   data_list=args.val_list, transform=val_transform, mode='val', \
+                                   use_coco=args.use_coco, use_split_coco=args.use_split_coco, args=args, meta_aug=0)       # 用 val_list.txt
+    if isinstance(val_data, dataset.EpisodeDataset):
+        val_sampler = None
+        if args.distributed:        # 每个进程评测 episode rank, rank + world_size, ..., 最后汇总计数
+            val_sampler = range(args.rank, len(val_data), args.world_size)
+    elif args.distributed:      # 现场采样的分片: 串行时全部 pass 的 (index, seed) 序列, 每个进程取其中的 rank::world_size
+        test_num, epoch_num = val_episode_num(val_data)
+        val_sampler = dataset.SeededSampler(range(len(val_data)), seed=args.manual_seed or 0, passes=epoch_num,
+                                            num=test_num + 1, rank=args.rank, world_size=args.world_size)
+    else:      # 现场采样: 每个 episode 由 seed 决定, 与 worker 无关
+        val_sampler = dataset.SeededSampler(range(len(val_data)), seed=args.manual_seed or 0)
+    val_loader = torch.utils.data.DataLoader(val_data, batch_size=args.batch_size_val, shuffle=False,
+                                             sampler=val_sampler, collate_fn=dataset.episode_collate, **kwargs)
+    if args.get('prefetch', 2) > 0:
+        val_loader = dataset.PrefetchLoader(val_loader, device, args.get('prefetch', 2))
+    return val_loader
+
+
+def main_worker(local_rank, ngpus_per_node, argss):
+    global args
+    args = argss
+    loaded_cfg = args.pop('loaded_cfg', None) or {}
+    if args.distributed:
+        if args.dist_url == "env://" and args.rank == -1:
+            args.rank = int(os.environ["RANK"])
+        if args.multiprocessing_distributed:
+            args.rank = args.rank * ngpus_per_node + local_rank
+        backend = args.get('dist_backend', 'nccl') if args.cuda else 'gloo'    # cpu 只支持 gloo
+        dist.init_process_group(backend=backend, init_method=args.dist_url, world_size=args.world_size, rank=args.rank)
+        assert args.batch_size % args.world_size == 0
+        args.batch_size = args.batch_size // args.world_size     # 每个进程的 batch
+        local_procs = ngpus_per_node if args.multiprocessing_distributed else int(os.environ.get("LOCAL_WORLD_SIZE", 1))
+        args.workers = (args.workers + local_procs - 1) // local_procs
+    else:
+        args.rank, args.world_size = 0, 1
+        local_procs = 1
+    assert args.batch_size % args.get('accumulate_steps', 1) == 0
     if args.manual_seed is not None:
         np.random.seed(args.manual_seed)
         torch.manual_seed(args.manual_seed)
@@ -69,15 +184,14 @@ def main():
             torch.cuda.manual_seed(args.manual_seed)
 
 
-    BatchNorm = nn.BatchNorm2d
     criterion = nn.CrossEntropyLoss(ignore_index=args.ignore_label)
-
-    model = PFENet(layers=args.layers, classes=2, zoom_factor=8, \
-                   criterion=nn.CrossEntropyLoss(ignore_index=255), BatchNorm=BatchNorm, \
-                   pretrained=True, shot=args.shot, ppm_scales=args.ppm_scales, vgg=args.vgg)   # if arg.vgg=False then use Resnet
-    global device
-    device = torch.device("cuda:0" if args.cuda else "cpu")
+    model = get_model()
+    global device, backbone_sha
+    device = torch.device("cuda:{}".format(local_rank) if args.cuda else "cpu")
+    if args.cuda:
+        torch.cuda.set_device(device)
     model = model.to(device)
+    backbone_sha = backbone_hash(model)     # head-only checkpoint 引用的预训练 backbone
 
     for param in model.layer0.parameters():     #################################################### param and optimizer
         param.requires_grad = False
@@ -103,34 +217,59 @@ def main():
             {'params': model.cls.parameters()}],
         lr=args.base_lr, momentum=args.momentum, weight_decay=args.weight_decay)
 
-    global logger, writer        ######################################################################### write the log
+    global logger, writer, ckpt_writer        ############################################################ write the log
     logger = get_logger()
-    writer = SummaryWriter(args.save_path)
+    writer, ckpt_writer = None, None      # 只有主进程写 tensorboard / checkpoint
+    if main_process():
+        from tensorboardX import SummaryWriter     # 只有主进程用到 (spawn 出的其他 rank / evaluator 进程不导入)
+        writer = SummaryWriter(args.save_path)
+        # checkpoint 在后台线程写入, 只保留 keep_best 个最好的和 keep_last 个最近 (每 save_freq 个 epoch) 的
+        ckpt_writer = CheckpointWriter(keep_best=args.get('keep_best', 1), keep_last=args.get('keep_last', 2), logger=logger)
+    else:
+        logger.setLevel(logging.WARNING)
     logger.info("=> creating model ...")
     logger.info("Classes: {}".format(args.classes))
     logger.info(model)
-    print(args)
+    if main_process():
+        print(args)
 
     if args.weight:     ############################################################### load pretrained weight or resume
         if os.path.isfile(args.weight):
             logger.info("=> loading weight '{}'".format(args.weight))
-            checkpoint = torch.load(args.weight)
-            model.load_state_dict(checkpoint['state_dict'])
+            checkpoint = torch.load(args.weight, map_location=device)
+            load_checkpoint_weights(model, checkpoint, backbone_sha)
             logger.info("=> loaded weight '{}'".format(args.weight))
         else:
             logger.info("=> no weight found at '{}'".format(args.weight))
 
+    resume_checkpoint, train_state = None, None      # latest.pth: 从 epoch 中间的 iter 继续 (sampler 位置, RNG, meter, scaler)
     if args.resume:
         if os.path.isfile(args.resume):
             logger.info("=> loading checkpoint '{}'".format(args.resume))
-            checkpoint = torch.load(args.resume, map_location=lambda storage, loc: storage.cuda())
+            checkpoint = torch.load(args.resume, map_location=device)
             args.start_epoch = checkpoint['epoch']
-            model.load_state_dict(checkpoint['state_dict'])
+            load_checkpoint_weights(model, checkpoint, backbone_sha)
             optimizer.load_state_dict(checkpoint['optimizer'])
-            logger.info("=> loaded checkpoint '{}' (epoch {})".format(args.resume, checkpoint['epoch']))
+            resume_checkpoint = checkpoint
+            if checkpoint.get('iter', 0) > 0:
+                train_state = checkpoint
+            logger.info("=> loaded checkpoint '{}' (epoch {}, iter {})".format(args.resume, checkpoint['epoch'], checkpoint.get('iter', 0)))
         else:
             logger.info("=> no checkpoint found at '{}'".format(args.resume))
 
+    global amp_dtype, scaler        # 混合精度: use_apex + opt_level (O1: autocast, O2/O3: backbone 也转为低精度)
+    amp_dtype = get_amp_dtype(args, device)
+    scaler = get_grad_scaler(args, amp_dtype)
+    if resume_checkpoint is not None and 'scaler' in resume_checkpoint:
+        scaler.load_state_dict(resume_checkpoint['scaler'])
+    if amp_dtype is not None:
+        cast_backbone(model, amp_dtype, args.opt_level, args.get('keep_batchnorm_fp32', None))
+        logger.info("=> mixed precision: {} {}".format(args.opt_level, amp_dtype))
+    if args.distributed:     # 只有 head 有梯度; backbone BN 的 running stats 每次 forward 从 rank 0 广播
+        model = nn.parallel.DistributedDataParallel(model, device_ids=[local_rank] if args.cuda else None)
+        logger.info("=> DistributedDataParallel: {} processes ({}, {}), batch {} per process".format(
+            args.world_size, dist.get_backend(), args.dist_url, args.batch_size))
+
     value_scale = 255   ############################################################## load train/val data and transform
     mean = [0.485, 0.456, 0.406]
     mean = [item * value_scale for item in mean]
@@ -149,37 +288,55 @@ def main():
     train_transform = transform.Compose(train_transform)
     train_data = dataset.SemData(split=args.split, shot=args.shot, data_root=args.data_root, \
                                  data_list=args.train_list, transform=train_transform, mode='train', \
-                                 use_coco=args.use_coco, use_split_coco=args.use_split_coco)
+                                 use_coco=args.use_coco, use_split_coco=args.use_split_coco, args=args)
 
-    train_sampler = None
-    kwargs = {'num_workers': args.workers, 'pin_memory': True} if args.cuda else {}
-    train_loader = torch.utils.data.DataLoader(train_data, batch_size=args.batch_size, shuffle=(train_sampler is None),
-                                               sampler=train_sampler, drop_last=True, **kwargs
+    if args.get('episode_sampler', False):     # class-balanced episodes, 数据集中不再做 support 的 rejection sampling
+        train_sampler = dataset.EpisodeSampler(train_data, seed=args.manual_seed or 0,
+                                               num_replicas=args.world_size, rank=args.rank)
+    else:
+        # 每个 epoch 的顺序和每个 episode 的 seed 只由 (manual_seed, epoch) 决定, 与 worker 无关:
+        # persistent_workers 时 worker 的 RNG 不随 epoch 重新设置, 从 epoch 开始处续训仍得到相同的 episodes
+        # DDP: 每个进程取 rank::world_size, 丢掉多出的不足 world_size 个, 各进程的 iter 数相同
+        num = len(train_data) // args.world_size * args.world_size if args.distributed else None
+        train_sampler = dataset.SeededSampler(range(len(train_data)), seed=args.manual_seed or 0, num=num,
+                                              rank=args.rank, world_size=args.world_size, shuffle=True)
+    if args.get('autotune_workers', False):    # 按本进程可用的 cpu 实测 train loader 的吞吐, 选 workers/prefetch_factor/persistent_workers
+        rng_state = get_rng_state()           # 测量时 SemData 的采样不影响之后训练的 RNG
+        setting = dataset.autotune_loader(train_data, args.batch_size, sampler=train_sampler,
+                                          cpus=max(1, dataset.available_cpus() // local_procs), logger=logger,
+                                          collate_fn=dataset.episode_collate, pin_memory=args.cuda)
+        set_rng_state(rng_state)
+        args.workers = setting['num_workers']
+        args.prefetch_factor = setting.get('prefetch_factor', args.get('prefetch_factor', 2))
+        args.persistent_workers = setting.get('persistent_workers', False)
+        # 可复现的配置里记下 autotune 的结果 (workers 为每个节点的总数, 与 config 中的含义相同), 不再重新测量
+        loaded_cfg.update(workers=args.workers * local_procs, prefetch_factor=args.prefetch_factor,
+                          persistent_workers=args.persistent_workers, autotune_workers=False)
+    if main_process():       # 读入的配置 (含 autotune 的结果), 可以直接作为 --config 重新运行; 每个进程的实际值只记在 log 里
+        config.dump_cfg(loaded_cfg, os.path.join(args.save_path, 'config.yaml'))
+        logger.info('=> per process: rank {}/{}, batch_size {}, workers {}, prefetch_factor {}, persistent_workers {}'.format(
+            args.rank, args.world_size, args.batch_size, args.workers, args.get('prefetch_factor', 2), args.get('persistent_workers', False)))
+    kwargs = loader_kwargs()
+    # 用独立的 generator: 创建 iterator 不消耗全局 torch RNG, 续训时 dropout 的 RNG 与不中断时一致
+    generator = torch.Generator()
+    train_loader = torch.utils.data.DataLoader(train_data, batch_size=args.batch_size, shuffle=False,
+                                               sampler=train_sampler, drop_last=True, collate_fn=dataset.episode_collate,
+                                               generator=generator, **kwargs
                                                )   # 每个episode为一个样本， 一个batch为多个episodes
-    if args.evaluate:
-        if args.resized_val:
-            val_transform = transform.Compose([
-                transform.Resize(size=args.val_size),
-                transform.ToTensor(),
-                transform.Normalize(mean=mean, std=std)])
-        else:
-            val_transform = transform.Compose([
-                transform.test_Resize(size=args.val_size),
-                transform.ToTensor(),
-                transform.Normalize(mean=mean, std=std)])
-        # val 数据用 val_list.txt(从val数据中选择），其class从sub_val_list中选择，与训练数据不能重合
-        val_data = dataset.SemData(split=args.split, shot=args.shot, data_root=args.data_root, \
-                                   data_list=args.val_list, transform=val_transform, mode='val', \
-                                   use_coco=args.use_coco, use_split_coco=args.use_split_coco)       # 用 val_list.txt
-        val_sampler = None
-        val_loader = torch.utils.data.DataLoader(val_data, batch_size=args.batch_size_val, shuffle=False,
-                                                 sampler=val_sampler, **kwargs)
-
-
-    max_iou = 0.        ######################################################################################## 开始训练
-
+    if args.get('prefetch', 2) > 0:      # 后台线程提前准备 (并拷贝到 gpu) 之后的 batch
+        train_loader = dataset.PrefetchLoader(train_loader, device, args.get('prefetch', 2))
+    evaluator = None
+    if args.evaluate and not args.get('async_val', False):
+        val_loader = get_val_loader()
+    elif args.evaluate and main_process():      # async_val: 只有主进程评测, 在另一个进程中进行
+        evaluator = AsyncEvaluator(args, device)
+
+    global max_iou, val_cache
+    val_cache = None     # 上次 validate() 的 (head_hash, 结果)
+    max_iou = resume_checkpoint.get('max_iou', 0.) if resume_checkpoint is not None else 0.    ############# 开始训练
     for epoch in range(args.start_epoch, args.epochs):
-        if args.fix_random_seed_val:
+        resume_state = train_state if epoch == args.start_epoch else None
+        if args.fix_random_seed_val and resume_state is None:     # 中途续训时 RNG 由 checkpoint 恢复
             np.random.seed(args.manual_seed + epoch)              ########################################################## 为什么要两次set seed, 而且每个epoch都要重新选
             random.seed(args.manual_seed + epoch)
             torch.manual_seed(args.manual_seed + epoch)
@@ -187,53 +344,76 @@ def main():
                 torch.cuda.manual_seed(args.manual_seed + epoch)
                 torch.cuda.manual_seed_all(args.manual_seed + epoch)
 
+        train_sampler.set_epoch(epoch)
+        if resume_state is not None:
+            train_sampler.load_state_dict(resume_state['sampler'])
         epoch_log = epoch + 1
-        loss_train, mIoU_train, mAcc_train, allAcc_train = train(train_loader, model, optimizer, epoch, args)
+        loss_train, mIoU_train, mAcc_train, allAcc_train = train(train_loader, model, optimizer, epoch, args, resume_state)
 
-        writer.add_scalar('loss_train', loss_train, epoch_log)
-        writer.add_scalar('mIoU_train', mIoU_train, epoch_log)
-        writer.add_scalar('mAcc_train', mAcc_train, epoch_log)
-        writer.add_scalar('allAcc_train', allAcc_train, epoch_log)
+        if main_process():
+            writer.add_scalar('loss_train', loss_train, epoch_log)
+            writer.add_scalar('mIoU_train', mIoU_train, epoch_log)
+            writer.add_scalar('mAcc_train', mAcc_train, epoch_log)
+            writer.add_scalar('allAcc_train', allAcc_train, epoch_log)
 
         if args.evaluate and (epoch % 2 == 0 or (args.epochs <= 50 and epoch % 1 == 0)):
-            loss_val, mIoU_val, mAcc_val, allAcc_val, class_miou = validate(val_loader, model, criterion)
-
-            writer.add_scalar('loss_val', loss_val, epoch_log)
-            writer.add_scalar('mIoU_val', mIoU_val, epoch_log)
-            writer.add_scalar('mAcc_val', mAcc_val, epoch_log)
-            writer.add_scalar('class_miou_val', class_miou, epoch_log)
-            writer.add_scalar('allAcc_val', allAcc_val, epoch_log)
-            if class_miou > max_iou:
-                max_iou = class_miou
-#                if os.path.exists(filename):
-#                    os.remove(filename)
-                filename = args.save_path + '/train_epoch_' + str(epoch) + '_' + str(max_iou) + '.pth'
-                logger.info('Saving checkpoint to: ' + filename)
-                torch.save({'epoch': epoch, 'state_dict': model.state_dict(), 'optimizer': optimizer.state_dict()},
-                           filename)
-
-    filename = args.save_path + '/final.pth'
-    logger.info('Saving checkpoint to: ' + filename)
-    torch.save({'epoch': args.epochs, 'state_dict': model.state_dict(), 'optimizer': optimizer.state_dict()}, filename)
-
-
-def train(train_loader, model, optimizer, epoch, args):
+            if evaluator is not None:     # 交给 evaluator 进程, 结果到达时再写 tensorboard 和选 best checkpoint
+                evaluator.submit(epoch, dict(model_state(model), epoch=epoch, optimizer=optimizer.state_dict()))
+            elif not args.get('async_val', False):
+                # 不经过 DDP wrapper, eval 的 forward 不需要进程间同步
+                val_finished(epoch, validate(val_loader, unwrap(model), criterion),
+                             lambda: dict(model_state(model), epoch=epoch, optimizer=optimizer.state_dict()))
+        if evaluator is not None:
+            for result in evaluator.results():
+                val_finished(*result)
+        if args.save_freq and epoch_log % args.save_freq == 0 and main_process():
+            filename = args.save_path + '/train_epoch_' + str(epoch) + '.pth'
+            logger.info('Saving checkpoint to: ' + filename)
+            ckpt_writer.save(dict(model_state(model), epoch=epoch_log, optimizer=optimizer.state_dict()),
+                             filename, kind='last')
+        if args.get('save_iter_freq', 0) > 0:     # epoch 结束: 续训从下一个 epoch 开始
+            save_train_state(model, optimizer, None, train_sampler, epoch + 1, 0)
+
+    if evaluator is not None:     # 等待剩下的评测结果
+        for result in evaluator.results(wait=True):
+            val_finished(*result)
+        evaluator.close()
+    if main_process():
+        filename = args.save_path + '/final.pth'
+        logger.info('Saving checkpoint to: ' + filename)
+        ckpt_writer.save(dict(model_state(model), epoch=args.epochs, optimizer=optimizer.state_dict()), filename)
+        ckpt_writer.close()
+        writer.close()                            # spawn 的子进程退出前关掉 tensorboard 的写线程
+    if args.distributed:
+        dist.destroy_process_group()
+
+
+def train(train_loader, model, optimizer, epoch, args, resume_state=None):
     batch_time = AverageMeter()
     data_time = AverageMeter()
-    main_loss_meter = AverageMeter()
-    aux_loss_meter = AverageMeter()
-    loss_meter = AverageMeter()
-    intersection_meter = AverageMeter()
-    union_meter = AverageMeter()
-    target_meter = AverageMeter()
+    meter = TrainMeter(args.classes, args.ignore_label)   # loss 和 intersection/union 留在 device 上, 每 print_freq 个 iter 才同步
+    start_iter = 0
+    if resume_state is not None:     # 从 checkpoint 的 iter 继续, sampler 已跳过之前的 episodes
+        start_iter = resume_state['iter']
+        # 每个进程的 meter / RNG 分别保存 (见 save_train_state)
+        assert len(resume_state['rng']) == args.world_size, "resume with {} processes, saved with {}".format(
+            args.world_size, len(resume_state['rng']))
+        meter.load_state_dict(resume_state['meter'][args.rank])
+        set_rng_state(resume_state['rng'][args.rank])
+    save_iter_freq = args.get('save_iter_freq', 0)     # EpisodeSampler / SeededSampler 都可以从 epoch 中间继续
 
     model.train()
-    end = time.time()
+    end = epoch_start = time.time()
+    stall = 0.
     max_iter = args.epochs * len(train_loader)     # 所有epoch 总共多少iter
+    accumulate_steps = args.get('accumulate_steps', 1)
     print('Warmup: {}'.format(args.warmup))
-    for i, (input, target, s_input, s_mask, subcls) in enumerate(train_loader):
+    for i, (input, target, s_input, s_mask, subcls, s_valid) in enumerate(train_loader, start_iter):
         # input [B, 3, 473, 473], target:[B, 473, 473], s_input:[B, K, 3, 473, 473], s_mask:[B,K,473,473], subcls[list of cls w.r.t. B samples]
+        # s_valid: [B, K] 补齐 support 的 mask (None: 没有补齐), 见 dataset.episode_collate
         data_time.update(time.time() - end)
+        if i == start_iter:
+            stall = data_time.val      # epoch 开始时等第一个 batch (worker 启动) 的时间
         current_iter = epoch * len(train_loader) + i + 1
         index_split = -1
         if args.base_lr > 1e-6:                                                  # decay the learning rate in each batch
@@ -245,76 +425,230 @@ def train(train_loader, model, optimizer, epoch, args):
             s_mask = s_mask.cuda(non_blocking=True)
             input = input.cuda(non_blocking=True)
             target = target.cuda(non_blocking=True)
+            if s_valid is not None:
+                s_valid = s_valid.cuda(non_blocking=True)
 
-        output, main_loss, aux_loss = model(s_x=s_input, s_y=s_mask, x=input, y=target)
-
-        if not args.multiprocessing_distributed:
-            main_loss, aux_loss = torch.mean(main_loss), torch.mean(aux_loss)              ##################################
-        loss = main_loss + args.aux_weight * aux_loss
-        optimizer.zero_grad()
-
-        loss.backward()
-        optimizer.step()
         n = input.size(0)   # batch_size
-        if args.multiprocessing_distributed:
-            main_loss, aux_loss, loss = main_loss.detach() * n, aux_loss * n, loss * n
-            count = target.new_tensor([n], dtype=torch.long)
-            dist.all_reduce(main_loss), dist.all_reduce(aux_loss), dist.all_reduce(loss), dist.all_reduce(count)
-            n = count.item()
-            main_loss, aux_loss, loss = main_loss / n, aux_loss / n, loss / n
-
-        intersection, union, target = intersectionAndUnionGPU(output, target, args.classes, args.ignore_label)
-        if args.multiprocessing_distributed:
-            dist.all_reduce(intersection), dist.all_reduce(union), dist.all_reduce(target)
-        intersection, union, target = intersection.cpu().numpy(), union.cpu().numpy(), target.cpu().numpy()
-        intersection_meter.update(intersection), union_meter.update(union), target_meter.update(target)
-
-        accuracy = sum(intersection_meter.val) / (sum(target_meter.val) + 1e-10)  # inter_meter [num0, num1], target_meter[num0, num1]
-        main_loss_meter.update(main_loss.item(), n)
-        aux_loss_meter.update(aux_loss.item(), n)
-        loss_meter.update(loss.item(), n)
-        batch_time.update(time.time() - end)    #跑完batch所需要时间
+        optimizer.zero_grad()
+        main_loss, aux_loss, loss, output = 0, 0, 0, []
+        # gradient accumulation: batch 分成 accumulate_steps 个 micro-batch 依次 forward/backward, 每个 batch 只 step 一次
+        micro_s_valid_list = s_valid.chunk(accumulate_steps) if s_valid is not None else [None] * accumulate_steps
+        micro_batches = list(zip(input.chunk(accumulate_steps), target.chunk(accumulate_steps),
+                                 s_input.chunk(accumulate_steps), s_mask.chunk(accumulate_steps), micro_s_valid_list))
+        for k, (micro_input, micro_target, micro_s_input, micro_s_mask, micro_s_valid) in enumerate(micro_batches):
+            weight = micro_input.size(0) / n     # 按样本数加权, 累积的梯度即整个 batch 的平均
+            # DDP: 只在最后一个 micro-batch 的 backward 做梯度 all-reduce
+            no_sync = model.no_sync() if args.distributed and k < len(micro_batches) - 1 else contextlib.nullcontext()
+            with no_sync:
+                with amp_autocast(device, amp_dtype):
+                    micro_output, micro_main_loss, micro_aux_loss = model(s_x=micro_s_input, s_y=micro_s_mask, x=micro_input,
+                                                                          y=micro_target, s_valid=micro_s_valid)
+
+                    if not args.distributed:
+                        micro_main_loss, micro_aux_loss = torch.mean(micro_main_loss), torch.mean(micro_aux_loss)              ##################################
+                    micro_loss = micro_main_loss + args.aux_weight * micro_aux_loss
+
+                scaler.scale(micro_loss * weight).backward()     # fp16 时 loss scaling, 否则等同 loss.backward()
+            main_loss = main_loss + micro_main_loss.detach() * weight
+            aux_loss = aux_loss + micro_aux_loss.detach() * weight
+            loss = loss + micro_loss.detach() * weight
+            output.append(micro_output)
+
+        scaler.step(optimizer)
+        scaler.update()
+        output = torch.cat(output, 0)
+        meter.update(main_loss, aux_loss, loss, output, target, n)
+        batch_time.update(time.time() - end)    #跑完batch所需要时间 (不同步, 只在 print_freq 取平均时准确)
         end = time.time()
 
+        save_now = save_iter_freq > 0 and (i + 1) % save_iter_freq == 0 and i + 1 < len(train_loader)
+        if (i + 1) % args.print_freq == 0 or i + 1 == len(train_loader) or save_now:
+            flush_train_log(meter, epoch, i, len(train_loader), current_iter, max_iter, batch_time, data_time)
+        if save_now:
+            save_train_state(model, optimizer, meter, train_loader.sampler, epoch, i + 1)
+
+    if args.distributed:   # epoch 结束时汇总所有进程的 loss 与计数
+        count = meter.loss_sum.new_tensor([meter.count])
+        dist.all_reduce(meter.loss_sum), dist.all_reduce(meter.meter.confusion), dist.all_reduce(count)
+        meter.count = int(count.item())
+    main_loss, aux_loss, loss, mIoU, mAcc, allAcc, iou_class, accuracy_class = meter.get_results()
+
+    episode_num = (len(train_loader) - start_iter) * args.batch_size * args.world_size
+    logger.info('Train throughput at epoch [{}/{}]: {:.2f} episodes/s ({} processes), first batch after {:.3f}s.'.format(
+        epoch, args.epochs, episode_num / (time.time() - epoch_start), args.world_size, stall))
+    logger.info('Train result at epoch [{}/{}]: mIoU/mAcc/allAcc {:.4f}/{:.4f}/{:.4f}.'.format(
+        epoch, args.epochs, mIoU, mAcc, allAcc))
+    for i in range(args.classes):
+        logger.info('Class_{} Result: iou/accuracy {:.4f}/{:.4f}.'.format(i, iou_class[i], accuracy_class[i]))
+    return main_loss, mIoU, mAcc, allAcc
+
+
+def val_finished(epoch, results, state):
+    # 写 tensorboard, class_miou 最好时保存 state (被评测的模型, 或返回它的函数)
+    global max_iou
+    loss_val, mIoU_val, mAcc_val, allAcc_val, class_miou = results
+    epoch_log = epoch + 1
+    if main_process():
+        writer.add_scalar('loss_val', loss_val, epoch_log)
+        writer.add_scalar('mIoU_val', mIoU_val, epoch_log)
+        writer.add_scalar('mAcc_val', mAcc_val, epoch_log)
+        writer.add_scalar('class_miou_val', class_miou, epoch_log)
+        writer.add_scalar('allAcc_val', allAcc_val, epoch_log)
+    if class_miou > max_iou:
+        max_iou = class_miou
+        filename = args.save_path + '/train_epoch_' + str(epoch) + '_' + str(max_iou) + '.pth'
+        if main_process():
+            logger.info('Saving checkpoint to: ' + filename)
+            ckpt_writer.save(state() if callable(state) else state, filename, kind='best', metric=max_iou)
+
+
+class AsyncEvaluator(object):
+    """Runs validate() in a separate (spawned) process on snapshots of the model, so training does not wait for it.
+
+    submit() hands over a cpu snapshot of a checkpoint (blocks while `depth` of them are queued); results()
+    returns the (epoch, validate() results, snapshot) of the finished ones, in order.
+    """
+    def __init__(self, args, device, depth=1):
+        ctx = mp.get_context('spawn')
+        self.jobs, self.done = ctx.Queue(maxsize=depth), ctx.Queue()
+        self.pending = collections.OrderedDict()     # epoch -> snapshot, 等待评测结果
+        self.process = ctx.Process(target=evaluator_worker, args=(args, device, self.jobs, self.done))
+        self.process.start()
+
+    def submit(self, epoch, state):
+        state = cpu_snapshot(state)
+        self.pending[epoch] = state
+        self.put((epoch, {k: v for k, v in state.items() if k != 'optimizer'}))
+
+    def put(self, job):
+        while True:
+            try:
+                return self.jobs.put(job, timeout=5)
+            except queue.Full:
+                self.check()
+
+    def results(self, wait=False):
+        finished = []
+        while self.pending:
+            try:
+                epoch, results = self.done.get(timeout=5) if wait else self.done.get_nowait()
+            except queue.Empty:
+                if not wait:
+                    break
+                self.check()
+                continue
+            finished.append((epoch, results, self.pending.pop(epoch)))
+        return finished
+
+    def check(self):
+        if not self.process.is_alive():
+            raise RuntimeError('evaluator process exited with code {}'.format(self.process.exitcode))
+
+    def close(self):
+        self.put(None)
+        self.process.join()
+
+
+def evaluator_worker(argss, device_, jobs, done):
+    # AsyncEvaluator 的进程: 自己构建模型 (预训练 backbone) 和 val_loader, 载入收到的 head 后 validate()
+    global args, logger, device, amp_dtype, val_cache
+    args = argss
+    args.distributed, args.rank, args.world_size = False, 0, 1
+    logger = get_logger()
+    device = device_
+    model = get_model().to(device)
+    sha = backbone_hash(model)
+    amp_dtype = get_amp_dtype(args, device)
+    if amp_dtype is not None:
+        cast_backbone(model, amp_dtype, args.opt_level, args.get('keep_batchnorm_fp32', None))
+    criterion = nn.CrossEntropyLoss(ignore_index=args.ignore_label)
+    val_loader = get_val_loader()
+    val_cache = None
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        epoch, checkpoint = job
+        load_checkpoint_weights(model, checkpoint, sha)
+        logger.info('=> evaluating epoch {}'.format(epoch + 1))
+        done.put((epoch, validate(val_loader, model, criterion)))
+
+
+def model_state(model):
+    # save_head_only: 只保存 head (和 BN running stats), 冻结的 backbone 参数用 hash 引用 initmodel 中的预训练权重
+    model = unwrap(model)
+    if args.get('save_head_only', True):
+        return {'state_dict': head_state_dict(model), 'backbone': 'vgg16_bn' if args.vgg else 'resnet{}'.format(args.layers),
+                'backbone_hash': backbone_sha}
+    return {'state_dict': model.state_dict()}
+
+
+def save_train_state(model, optimizer, meter, sampler, epoch, iter_num):
+    # save_path/latest.pth: 用 resume 加载后从 epoch 的第 iter_num 个 iter 继续
+    # 所有进程都要调用: RNG 和 meter 是每个进程各自的, 汇总到主进程保存
+    filename = args.save_path + '/latest.pth'
+    rng = [get_rng_state()]
+    meters = [meter.state_dict()] if iter_num > 0 else [None]
+    if args.distributed:
+        rng, meters = gather_objects(rng[0]), gather_objects(meters[0])
+    if not main_process():
+        return
+    state = dict(model_state(model), epoch=epoch, iter=iter_num, optimizer=optimizer.state_dict(),
+                 scaler=scaler.state_dict(), rng=rng, max_iou=max_iou)
+    if iter_num > 0:
+        state['meter'] = meters
+        state['sampler'] = dict(sampler.state_dict(), start=iter_num * args.batch_size)
+    logger.info('Saving checkpoint to: {} (epoch {}, iter {})'.format(filename, epoch, iter_num))
+    ckpt_writer.save(state, filename)
+
+
+def gather_objects(obj):
+    objs = [None] * args.world_size
+    dist.all_gather_object(objs, obj)
+    return objs
+
+
+def flush_train_log(meter, epoch, i, iter_num, current_iter, max_iter, batch_time, data_time):
+    # 一次性取回上次 flush 之后每个 iter 的 loss 与 intersection/union, 逐 iter 写 tensorboard, 只为最后一个 iter 打 log
+    steps = meter.flush()
+    if not main_process():
+        return
+    for k, (main_loss, aux_loss, loss, intersection, union, target) in enumerate(steps):
+        step_iter = current_iter - len(steps) + 1 + k
+        accuracy = sum(intersection) / (sum(target) + 1e-10)  # inter_meter [num0, num1], target_meter[num0, num1]
+        writer.add_scalar('loss_train_batch', main_loss, step_iter)  # 当前batch loss
+        writer.add_scalar('mIoU_train_batch', np.mean(intersection / (union + 1e-10)), step_iter)   # BG的IoU与FG的IoU平均
+        writer.add_scalar('mAcc_train_batch', np.mean(intersection / (target + 1e-10)), step_iter)  # ClassWise Acc 平均
+        writer.add_scalar('allAcc_train_batch', accuracy, step_iter)
+
+    if (i + 1) % args.print_freq == 0:
         remain_iter = max_iter - current_iter
         remain_time = remain_iter * batch_time.avg
         t_m, t_s = divmod(remain_time, 60)
         t_h, t_m = divmod(t_m, 60)
         remain_time = '{:02d}:{:02d}:{:02d}'.format(int(t_h), int(t_m), int(t_s))
-
-        if (i + 1) % args.print_freq == 0:
-            logger.info('Epoch: [{}/{}][{}/{}] '
-                        'Data {data_time.val:.3f} ({data_time.avg:.3f}) '
-                        'Batch {batch_time.val:.3f} ({batch_time.avg:.3f}) '
-                        'Remain {remain_time} '
-                        'MainLoss {main_loss_meter.val:.4f}'    # 当前batch loss 
-                        'AuxLoss {aux_loss_meter.val:.4f} '     
-                        'Loss {loss_meter.val:.4f} '
-                        'Accuracy {accuracy:.4f}.'.format(epoch + 1, args.epochs, i + 1, len(train_loader),
-                                                          batch_time=batch_time,
-                                                          data_time=data_time,
-                                                          remain_time=remain_time,
-                                                          main_loss_meter=main_loss_meter,
-                                                          aux_loss_meter=aux_loss_meter,
-                                                          loss_meter=loss_meter,
-                                                          accuracy=accuracy))
-
-        writer.add_scalar('loss_train_batch', main_loss_meter.val, current_iter)  # 当前batch loss
-        writer.add_scalar('mIoU_train_batch', np.mean(intersection / (union + 1e-10)), current_iter)   # BG的IoU与FG的IoU平均
-        writer.add_scalar('mAcc_train_batch', np.mean(intersection / (target + 1e-10)), current_iter)  # ClassWise Acc 平均
-        writer.add_scalar('allAcc_train_batch', accuracy, current_iter)
-
-    iou_class = intersection_meter.sum / (union_meter.sum + 1e-10)   # [BG_IoU, FG_IoU]
-    accuracy_class = intersection_meter.sum / (target_meter.sum + 1e-10)  #[FG_Acc, BG_Acc]
-    mIoU = np.mean(iou_class)
-    mAcc = np.mean(accuracy_class)                                          # ClassWise Acc的平均
-    allAcc = sum(intersection_meter.sum) / (sum(target_meter.sum) + 1e-10)  # 整体Acc
-
-    logger.info('Train result at epoch [{}/{}]: mIoU/mAcc/allAcc {:.4f}/{:.4f}/{:.4f}.'.format(
-        epoch, args.epochs, mIoU, mAcc, allAcc))
-    for i in range(args.classes):
-        logger.info('Class_{} Result: iou/accuracy {:.4f}/{:.4f}.'.format(i, iou_class[i], accuracy_class[i]))
-    return main_loss_meter.avg, mIoU, mAcc, allAcc
+        logger.info('Epoch: [{}/{}][{}/{}] '
+                    'Data {data_time.val:.3f} ({data_time.avg:.3f}) '
+                    'Batch {batch_time.val:.3f} ({batch_time.avg:.3f}) '
+                    'Remain {remain_time} '
+                    'MainLoss {main_loss:.4f}'    # 当前batch loss 
+                    'AuxLoss {aux_loss:.4f} '     
+                    'Loss {loss:.4f} '
+                    'Accuracy {accuracy:.4f}.'.format(epoch + 1, args.epochs, i + 1, iter_num,
+                                                      batch_time=batch_time,
+                                                      data_time=data_time,
+                                                      remain_time=remain_time,
+                                                      main_loss=main_loss,
+                                                      aux_loss=aux_loss,
+                                                      loss=loss,
+                                                      accuracy=accuracy))
+
+
+def val_episode_num(val_data):
+    # 现场采样时评测的 episode 数和最多遍历 val_list 的遍数
+    if args.split != 999:
+        return (20000 if args.use_coco else 5000), 10
+    return (len(val_data) + args.batch_size_val - 1) // args.batch_size_val, 10     # = len(val_loader)
 
 
 def validate(val_loader, model, criterion):
@@ -324,15 +658,11 @@ def validate(val_loader, model, criterion):
     model_time = AverageMeter()
     data_time = AverageMeter()
     loss_meter = AverageMeter()
-    intersection_meter = AverageMeter()
-    union_meter = AverageMeter()
-    target_meter = AverageMeter()
     if args.use_coco:
         split_gap = 20
     else:
         split_gap = 5
-    class_intersection_meter = [0] * split_gap
-    class_union_meter = [0] * split_gap
+    meter = IntersectionAndUnionMeter(args.classes, split_gap, args.ignore_label)   # 混淆矩阵留在 device 上, 最后才同步
 
     if args.manual_seed is not None and args.fix_random_seed_val:
         random.seed(args.manual_seed)
@@ -342,20 +672,43 @@ def validate(val_loader, model, criterion):
             torch.cuda.manual_seed(args.manual_seed)
             torch.cuda.manual_seed_all(args.manual_seed)
 
+    if args.distributed:     # DDP 各进程 backbone BN 的 running stats 不同, 统一用 rank 0 的 (即保存的模型) 评测
+        for buffer in model.buffers():
+            dist.broadcast(buffer, 0)
+    global val_cache
+    digest = None
+    if args.get('skip_unchanged_val', True):     # head 与上次评测时相同: 直接返回上次的结果
+        digest = [head_hash(model)]
+        if args.distributed:     # 所有进程按 rank 0 决定是否跳过
+            dist.broadcast_object_list(digest, 0)
+        digest = digest[0]
+        if val_cache is not None and val_cache[0] == digest:
+            logger.info('=> head unchanged since the last evaluation, skip it: class mIoU {:.4f}'.format(val_cache[1][-1]))
+            return val_cache[1]
 
     model.eval()
     end = time.time()
-    if args.split != 999:
-        if args.use_coco:
-            test_num = 20000
-        else:
-            test_num = 5000
+    val_sampler = val_loader.sampler
+    if isinstance(val_loader.dataset, dataset.EpisodeDataset) or args.distributed:
+        test_num = len(val_sampler)   # 单遍: episode list, 或 DDP 时本进程的那部分 episodes (见 get_val_loader)
+        epoch_num = 1
     else:
-        test_num = len(val_loader)
+        test_num, epoch_num = val_episode_num(val_loader.dataset)
     assert test_num % args.batch_size_val == 0
     iter_num = 0
-    for e in range(10):
-        for i, (input, target, s_input, s_mask, subcls, ori_label) in enumerate(val_loader):
+    loss_sum, loss_count = torch.zeros((), dtype=torch.float64, device=device), 0
+    seed_base = [0 if args.fix_random_seed_val else random.getrandbits(31)]    # SeededSampler: 第 e 遍用 seed_base + e
+    if args.distributed:     # 各进程用 rank 0 的 seed_base
+        dist.broadcast_object_list(seed_base, 0)
+    seed_base = seed_base[0]
+    stall = 0.     # 每一遍等第一个 batch 的时间
+    for e in range(epoch_num):
+        if isinstance(val_sampler, dataset.SeededSampler):
+            val_sampler.set_epoch(seed_base + e)
+        end = time.time()
+        for i, (input, target, s_input, s_mask, subcls, ori_label, s_valid) in enumerate(val_loader):
+            if i == 0:
+                stall += time.time() - end
             # input[1,3,473,473],target[1,473,473],s_input[1,1,3,473,473],s_mask[1,1,473,473], ori_label:[1,366,500]
             # val batch_size为1
             if (iter_num - 1) * args.batch_size_val >= test_num:
@@ -368,9 +721,13 @@ def validate(val_loader, model, criterion):
                 ori_label = ori_label.cuda(non_blocking=True)
                 s_input = s_input.cuda(non_blocking=True)
                 s_mask = s_mask.cuda(non_blocking=True)                                     # 为什么这里之前没有 转化为 cuda
+                if s_valid is not None:
+                    s_valid = s_valid.cuda(non_blocking=True)
 
             start_time = time.time()
-            output = model(s_x=s_input, s_y=s_mask, x=input, y=target)    # [B(1), 2, 473, 473]  是logit
+            with amp_autocast(device, amp_dtype):
+                output = model(s_x=s_input, s_y=s_mask, x=input, y=target, s_valid=s_valid)    # [B(1), 2, 473, 473]  是logit
+            output = output.float()
             model_time.update(time.time() - start_time)
 
             if args.ori_resize:       # 不用dataloader里的target, 而用ori_label, 并pad为方形
@@ -391,19 +748,16 @@ def validate(val_loader, model, criterion):
 
             output = output.max(1)[1]     # [B, h, w] 得到每个pixel对应class index
 
-            intersection, union, new_target = intersectionAndUnionGPU(output, target, args.classes, args.ignore_label)
-            intersection, union, target, new_target = intersection.cpu().numpy(), union.cpu().numpy(), target.cpu().numpy(), new_target.cpu().numpy()
-            intersection_meter.update(intersection), union_meter.update(union), target_meter.update(new_target)
-
             subcls = subcls[0].cpu().numpy()[0]    #其实每个iteration只针对一张query image,K个support img, len(subcls)=K, 里面只有一个class
-            class_intersection_meter[(subcls - 1) % split_gap] += intersection[1]   # intersection[1]是针对FG
-            class_union_meter[(subcls - 1) % split_gap] += union[1]                 # union中的fg
+            intersection, union, new_target = meter.update(output, target, subcls)   # FG 的 intersection/union 同时计入该 class
 
-            accuracy = sum(intersection_meter.val) / (sum(target_meter.val) + 1e-10)   # 累计的ACC
-            loss_meter.update(loss.item(), input.size(0))
+            loss_sum += loss.detach().double() * input.size(0)     # 留在 device 上, 循环结束后才同步
+            loss_count += input.size(0)
             batch_time.update(time.time() - end)
             end = time.time()
             if ((i + 1) % (test_num / 100) == 0):
+                accuracy = intersection.sum().item() / (new_target.sum().item() + 1e-10)
+                loss_meter.val, loss_meter.avg = loss.item(), loss_sum.item() / loss_count
                 logger.info('Test: [{}/{}] '
                             'Data {data_time.val:.3f} ({data_time.avg:.3f}) '
                             'Batch {batch_time.val:.3f} ({batch_time.avg:.3f}) '
@@ -414,19 +768,15 @@ def validate(val_loader, model, criterion):
                                                               loss_meter=loss_meter,
                                                               accuracy=accuracy))
 
-    iou_class = intersection_meter.sum / (union_meter.sum + 1e-10)
-    accuracy_class = intersection_meter.sum / (target_meter.sum + 1e-10)
-    mIoU = np.mean(iou_class)
-    mAcc = np.mean(accuracy_class)
-    allAcc = sum(intersection_meter.sum) / (sum(target_meter.sum) + 1e-10)
-
-    class_iou_class = []
-    class_miou = 0
-    for i in range(len(class_intersection_meter)):    # 每个class的总Intersection和Union和IoU
-        class_iou = class_intersection_meter[i] / (class_union_meter[i] + 1e-10)
-        class_iou_class.append(class_iou)
-        class_miou += class_iou
-    class_miou = class_miou * 1.0 / len(class_intersection_meter)
+    loss_total = torch.stack([loss_sum, torch.tensor(float(loss_count), dtype=torch.float64, device=device)])
+    if args.distributed:     # 汇总各进程的计数, 结果与单进程评测全部 episodes 相同
+        meter.confusion = meter.confusion.to(device)
+        dist.all_reduce(meter.confusion), dist.all_reduce(loss_total)
+    loss_total = loss_total.tolist()     # 与 confusion 一起, 整个 validate 只在这里同步一次
+    loss_meter.sum, loss_meter.count = loss_total[0], int(loss_total[1])
+    loss_meter.avg = loss_meter.sum / max(loss_meter.count, 1)
+    test_num = loss_meter.count
+    mIoU, mAcc, allAcc, class_miou, iou_class, accuracy_class, class_iou_class = meter.get_results()
     logger.info('meanIoU---Val result: mIoU {:.4f}.'.format(class_miou))   #每个class IoU然后取平均
     for i in range(split_gap):
         logger.info('Class_{} Result: iou {:.4f}.'.format(i + 1, class_iou_class[i]))
@@ -437,7 +787,10 @@ def validate(val_loader, model, criterion):
         logger.info('Class_{} Result: iou/accuracy {:.4f}/{:.4f}.'.format(i, iou_class[i], accuracy_class[i]))
     logger.info('<<<<<<<<<<<<<<<<< End Evaluation <<<<<<<<<<<<<<<<<')
 
-    print('avg inference time: {:.4f}, count: {}'.format(model_time.avg, test_num))
+    logger.info('Val loader stall: {:.3f}s waiting for the first batch of {} passes.'.format(stall, epoch_num))
+    if main_process():
+        print('avg inference time: {:.4f}, count: {}'.format(model_time.avg, test_num))
+    val_cache = (digest, (loss_meter.avg, mIoU, mAcc, allAcc, class_miou))
     return loss_meter.avg, mIoU, mAcc, allAcc, class_miou
 
 
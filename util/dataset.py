@@ -4,13 +4,19 @@ import os.path
 import cv2
 import numpy as np
 
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler, DataLoader, get_worker_info
+from torch.utils.data.dataloader import default_collate
 import torch.nn.functional as F
 import torch
 import random
 import time
+import threading
+import queue
+import collections
+import hashlib
 from tqdm import tqdm
 from .transform import Compose, FitCrop, RandScale, ColorJitter
+from . import lists
 
 IMG_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.ppm', '.bmp', '.pgm']
 
@@ -21,33 +27,30 @@ def is_image_file(filename):
     return any(filename_lower.endswith(extension) for extension in IMG_EXTENSIONS)
 
 
-def make_dataset(split=0, data_root=None, data_list=None, sub_list=None):    # data_list: query set. sub_list: support cls list
+def make_dataset(split=0, data_root=None, data_list=None, sub_list=None, cache_dir=None):    # data_list: query set. sub_list: support cls list
     # data_list 应该是所有图片数据 （meta train过程用train_list, meta_test过程用val_list)
     # scan所有的训练数据， 找到sub_list中的class与其多对应的image(img_path, label_path)
+    # cache_dir: 保存/复用扫描结果 (每张 label 都要读一遍, coco val 需要几分钟), 见 list_cache_file
     assert split in [0, 1, 2, 3, 10, 11, 999]
-    if not os.path.isfile(data_list):
-        raise (RuntimeError("Image list file do not exist: " + data_list + "\n"))
+    cache_file = list_cache_file(cache_dir, data_root, data_list, sub_list) if cache_dir and os.path.isfile(data_list) else None
+    if cache_file and os.path.isfile(cache_file):
+        print("Loading scanned list from {}".format(cache_file))
+        return load_list_cache(cache_file, data_root)
 
     # Shaban uses these lines to remove small objects:
     # if util.change_coordinates(mask, 32.0, 0.0).sum() > 2:
     #    filtered_item.append(item)      
     # which means the mask will be downsampled to 1/32 of the original size and the valid area should be larger than 2, 
     # therefore the area in original size should be accordingly larger than 2 * 32 * 32    
-    image_label_list = []  
-    list_read = open(data_list).readlines()
+    path_ids = {}                  # list 中的相对路径 -> id in the PathTable (interned), 与 data_root 的拼接推迟到取用时
+    image_ids, label_ids = [], []  # data_list 的第 i 项
     print("Processing data...".format(sub_list))
     sub_class_file_list = {}
     for sub_c in sub_list:
-        sub_class_file_list[sub_c] = []    # 每个class对应的image （img path, label path)
-
-    for l_idx in tqdm(range(len(list_read))):
-        line = list_read[l_idx]
-        line = line.strip()
-        line_split = line.split(' ')  # 分别得到 image 和 mask的路径
-        image_name = os.path.join(data_root, line_split[0])
-        label_name = os.path.join(data_root, line_split[1])
-        item = (image_name, label_name)
-        label = cv2.imread(label_name, cv2.IMREAD_GRAYSCALE)
+        sub_class_file_list[sub_c] = []    # 每个class对应的image, 存 data_list 中的 index
+
+    for image_name, label_name in tqdm(lists.read_list(data_list)):   # 逐行读取 image 和 mask的(相对)路径
+        label = cv2.imread(os.path.join(data_root, label_name), cv2.IMREAD_GRAYSCALE)
         label_class = np.unique(label).tolist()      # 当前图片所有的label/class
 
         if 0 in label_class:
@@ -68,21 +71,174 @@ def make_dataset(split=0, data_root=None, data_list=None, sub_list=None):    # d
         label_class = new_label_class      # 当前图片所有符合条件的cls
 
         if len(label_class) > 0:
-            image_label_list.append(item)   # 符合条件的image的 图片path + label path
             for c in label_class:
                 if c in sub_list:
-                    sub_class_file_list[c].append(item)     # 所有跟cls c相关的图片
-                    
+                    sub_class_file_list[c].append(len(image_ids))     # 所有跟cls c相关的图片
+            image_ids.append(path_ids.setdefault(image_name, len(path_ids)))   # 符合条件的image的 图片path + label path
+            label_ids.append(path_ids.setdefault(label_name, len(path_ids)))
+
     print("Checking image&label pair {} list done! ".format(split))
+    image_label_list = ImageLabelList(PathTable(path_ids), image_ids, label_ids, root=data_root)
+    sub_class_file_list = {c: IndexedList(image_label_list, indices) for c, indices in sub_class_file_list.items()}
+    if cache_file:
+        save_list_cache(cache_file, image_label_list, sub_class_file_list)
+    return image_label_list, sub_class_file_list
+    # image_label_list: 所有(image path, mask_path), 见 ImageLabelList
+    # sub_class_file_list： {c: 所有跟cls c相关的 （图片+其label path）, 为 image_label_list 的 int32 index}
+
+
+def list_cache_file(cache_dir, data_root, data_list, sub_list):
+    # 扫描结果只取决于 list 文件 (路径, 大小, 修改时间), data_root 和 sub_list; label 文件本身被认为不会变 (变了就删掉 cache)
+    stat = os.stat(data_list)
+    key = repr(['v1', os.path.abspath(data_list), stat.st_size, stat.st_mtime_ns, os.path.abspath(data_root or ''), sorted(sub_list)])
+    name = '{}_{}.npz'.format(os.path.splitext(os.path.basename(data_list))[0], hashlib.sha1(key.encode('utf-8')).hexdigest()[:16])
+    return os.path.join(cache_dir, name)
+
+
+def save_list_cache(cache_file, image_label_list, sub_class_file_list):
+    classes = sorted(sub_class_file_list.keys())
+    class_offsets = np.cumsum([0] + [len(sub_class_file_list[c]) for c in classes])
+    class_indices = np.concatenate([sub_class_file_list[c].indices for c in classes] + [np.zeros(0, dtype=np.int32)])
+    cache_dir = os.path.dirname(cache_file)
+    if cache_dir and not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+    tmp_file = '{}.tmp{}'.format(cache_file, os.getpid())    # 多个进程同时扫描时, 各写各的再 rename
+    with open(tmp_file, 'wb') as f:
+        np.savez(f, buffer=np.frombuffer(image_label_list.table.buffer, dtype=np.uint8), offsets=image_label_list.table.offsets,
+                 image_ids=image_label_list.image_ids, label_ids=image_label_list.label_ids,
+                 classes=np.array(classes, dtype=np.int64), class_offsets=class_offsets, class_indices=class_indices)
+    os.replace(tmp_file, cache_file)
+
+
+def load_list_cache(cache_file, data_root):
+    with np.load(cache_file) as cache:
+        table = PathTable([])
+        table.buffer, table.offsets = cache['buffer'].tobytes(), cache['offsets']
+        image_label_list = ImageLabelList(table, cache['image_ids'], cache['label_ids'], root=data_root)
+        class_offsets, class_indices = cache['class_offsets'], cache['class_indices']
+        sub_class_file_list = {int(c): IndexedList(image_label_list, class_indices[class_offsets[k]:class_offsets[k + 1]])
+                               for k, c in enumerate(cache['classes'].tolist())}
     return image_label_list, sub_class_file_list
-    # image_label_list: list of 所有(image path, mask_path)
-    # sub_class_file_list： {c: list of 所有跟cls c相关的 （图片+其label path）}
+
+
+class PathTable(object):
+    """Strings kept in one bytes buffer with int64 offsets; table[i] decodes the i-th one.
+
+    There are two objects instead of a python object per path, so forked loader workers only read their pages
+    (no refcount writes, no copy-on-write duplication), and the table pickles to spawned workers in one piece.
+    """
+    def __init__(self, paths):
+        encoded = [path.encode('utf-8') for path in paths]
+        self.offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(e) for e in encoded], out=self.offsets[1:])
+        self.buffer = b''.join(encoded)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        start, end = self.offsets[i:i + 2].tolist()
+        return self.buffer[start:end].decode('utf-8')
+
+
+class ImageLabelList(object):
+    # data_list: 第 i 项为 (image path, label path), 存为 PathTable 中 (相对 root 的) 路径的 int32 id, 取用时才拼上 root
+    def __init__(self, table, image_ids, label_ids, root=None):
+        self.table = table
+        self.root = root or ''
+        self.image_ids = np.asarray(image_ids, dtype=np.int32)
+        self.label_ids = np.asarray(label_ids, dtype=np.int32)
+
+    def __len__(self):
+        return len(self.image_ids)
+
+    def __getitem__(self, i):
+        return (os.path.join(self.root, self.table[int(self.image_ids[i])]),
+                os.path.join(self.root, self.table[int(self.label_ids[i])]))
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+class IndexedList(object):
+    # sub_class_file_list[c]: items 中 indices (int32) 的那些项
+    def __init__(self, items, indices):
+        self.items = items
+        self.indices = np.asarray(indices, dtype=np.int32)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, k):
+        return self.items[int(self.indices[k])]
+
+    def __iter__(self):
+        return (self[k] for k in range(len(self)))
+
+
+def make_episodes(data, episode_num, seed=None):
+    # 预先生成 episode_num 个 (query image, query label, class_chosen, [(support image, support label)]) 评测任务
+    # query 按 data_list 的顺序循环选取 (与 validate() 中 shuffle=False 的 val_loader 一致)
+    # support 从 sub_class_file_list[class_chosen] 中除 query 外的位置不放回抽样 (不需要 rejection sampling), 只解码选中的路径
+    rng = random.Random(seed)
+    label_class_cache = {}
+    episodes = []
+    for e_idx in tqdm(range(episode_num)):
+        index = e_idx % len(data.data_list)
+        image_path, label_path = data.data_list[index]
+        if index not in label_class_cache:
+            label_class_cache[index] = data.get_label_class(cv2.imread(label_path, cv2.IMREAD_GRAYSCALE))
+        label_class = label_class_cache[index]
+        assert len(label_class) > 0
+        class_chosen = label_class[rng.randint(1, len(label_class)) - 1]
+
+        file_class_chosen = data.sub_class_file_list[class_chosen]
+        query_pos = np.flatnonzero(file_class_chosen.indices == index)     # query 在 file_class_chosen 中的位置 (可能不在)
+        q = int(query_pos[0]) if len(query_pos) else len(file_class_chosen)
+        num_file = len(file_class_chosen) - len(query_pos)
+        if num_file < data.shot:
+            raise (RuntimeError("Not enough support images for class {}: {} < {}\n".format(class_chosen, num_file, data.shot)))
+        support_idx_list = [t + (t >= q) for t in rng.sample(range(num_file), data.shot)]     # 跳过 query 自身
+        episodes.append((image_path, label_path, class_chosen, [file_class_chosen[k] for k in support_idx_list]))
+    return episodes
+
+
+def save_episodes(episodes, episode_list, data_root=None):
+    # 每行: query_image query_label class_chosen support_image_1 support_label_1 ... (路径相对于 data_root)
+    def rel(path):
+        return os.path.relpath(path, data_root) if data_root else path
+
+    with open(episode_list, 'w') as f:
+        for image_path, label_path, class_chosen, supports in episodes:
+            items = [rel(image_path), rel(label_path), str(class_chosen)]
+            for support_image_path, support_label_path in supports:
+                items += [rel(support_image_path), rel(support_label_path)]
+            f.write(' '.join(items) + '\n')
+
+
+def load_episodes(episode_list, data_root=None):
+    if not os.path.isfile(episode_list):
+        raise (RuntimeError("Episode list file do not exist: " + episode_list + "\n"))
+
+    def full(path):
+        return os.path.join(data_root, path) if data_root else path
+
+    episodes = []
+    for line in open(episode_list):
+        line_split = line.strip().split(' ')
+        if len(line_split) < 5 or len(line_split) % 2 == 0:
+            raise (RuntimeError("Invalid episode in " + episode_list + ": " + line + "\n"))
+        paths = [full(path) for path in line_split[:2] + line_split[3:]]
+        supports = list(zip(paths[2::2], paths[3::2]))
+        episodes.append((paths[0], paths[1], int(line_split[2]), supports))
+    return episodes
 
 
 
 class SemData(Dataset):
+    # meta_aug: 覆盖 args 中的 meta_aug (train.py 训练中的 validate 只用原始 support, 传 0)
     def __init__(self, split=3, shot=1, data_root=None, data_list=None, transform=None, mode='train', use_coco=False, use_split_coco=False,
-                 args={}):
+                 args={}, meta_aug=None):
         assert mode in ['train', 'val', 'test']
         
         self.mode = mode
@@ -90,13 +246,36 @@ class SemData(Dataset):
         self.shot = shot
         self.data_root = data_root
 
-        self.meta_aug = args.get('meta_aug', 0)
+        if meta_aug is None:     # TEST_DATA_AUGMENT: support augmentation only for evaluation
+            meta_aug = args.get('meta_aug', 0) if mode != 'train' else 0
+        self.meta_aug = meta_aug
         self.aug_th = args.get('aug_th', [0.15, 0.30])
         self.aug_type = args.get('aug_type', 0)
         self.im_size = args.train_h if mode == 'train' else args.val_size
         if self.meta_aug > 1:
             print("INFO using data augmentation, meta_aug:{}".format(self.meta_aug))
 
+        self.set_class_list(use_coco, use_split_coco)
+
+        print('sub_list: ', self.sub_list)
+        print('sub_val_list: ', self.sub_val_list)    
+
+        if data_list is None:     # episodes are given explicitly, see EpisodeDataset
+            self.data_list, self.sub_class_file_list = [], {}
+        elif self.mode == 'train':
+            self.data_list, self.sub_class_file_list = make_dataset(split, data_root, data_list, self.sub_list, args.get('list_cache', None))
+            assert len(self.sub_class_file_list.keys()) == len(self.sub_list)
+        elif self.mode == 'val':
+            self.data_list, self.sub_class_file_list = make_dataset(split, data_root, data_list, self.sub_val_list, args.get('list_cache', None))
+            assert len(self.sub_class_file_list.keys()) == len(self.sub_val_list) 
+        self.transform = transform
+        # data_cache_mb: 每个 loader 进程缓存解码后的图片/label (LRU), persistent_workers 时跨 epoch 和 validate 保留
+        self.cache_limit = int(args.get('data_cache_mb', 0) * 2 ** 20)
+        self.cache, self.cache_bytes = collections.OrderedDict(), 0
+        self.label_class_cache = {}   # label path -> get_label_class, 只在 worker 内累积
+
+
+    def set_class_list(self, use_coco=False, use_split_coco=False):
         if not use_coco:
             self.class_list = list(range(1, 21)) #[1,2,3,4,5,6,7,8,9,10,11,12,13,14,15,16,17,18,19,20]
             if self.split == 3: 
@@ -142,33 +321,42 @@ class SemData(Dataset):
                     self.sub_val_list = list(range(21, 41))
                 elif self.split == 0:
                     self.sub_list = list(range(21, 81)) 
-                    self.sub_val_list = list(range(1, 21))    
-
-        print('sub_list: ', self.sub_list)
-        print('sub_val_list: ', self.sub_val_list)    
-
-        if self.mode == 'train':
-            self.data_list, self.sub_class_file_list = make_dataset(split, data_root, data_list, self.sub_list)
-            assert len(self.sub_class_file_list.keys()) == len(self.sub_list)
-        elif self.mode == 'val':
-            self.data_list, self.sub_class_file_list = make_dataset(split, data_root, data_list, self.sub_val_list)
-            assert len(self.sub_class_file_list.keys()) == len(self.sub_val_list) 
-        self.transform = transform
-
+                    self.sub_val_list = list(range(1, 21))
 
     def __len__(self):
         return len(self.data_list)
 
-    def __getitem__(self, index):
-        label_class = []
-        image_path, label_path = self.data_list[index]   # 用每一张图片 作为 query image
-        image = cv2.imread(image_path, cv2.IMREAD_COLOR) 
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)  
-        image = np.float32(image)
-        label = cv2.imread(label_path, cv2.IMREAD_GRAYSCALE)  
-
-        if image.shape[0] != label.shape[0] or image.shape[1] != label.shape[1]:
-            raise (RuntimeError("Query Image & label shape mismatch: " + image_path + " " + label_path + "\n"))          
+    def __getstate__(self):
+        # 传给 worker 进程时不带缓存的内容
+        state = self.__dict__.copy()
+        state['cache'], state['cache_bytes'], state['label_class_cache'] = collections.OrderedDict(), 0, {}
+        return state
+
+    def read(self, path, flag):
+        key = (path, flag)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        data = cv2.imread(path, flag)
+        if data is None:
+            raise (RuntimeError("Image cannot be read: " + path + "\n"))
+        if flag == cv2.IMREAD_COLOR:
+            data = cv2.cvtColor(data, cv2.COLOR_BGR2RGB)
+        if data.nbytes <= self.cache_limit:
+            self.cache[key] = data
+            self.cache_bytes += data.nbytes
+            while self.cache_bytes > self.cache_limit:
+                self.cache_bytes -= self.cache.popitem(last=False)[1].nbytes
+        return data
+
+    def read_image(self, path):
+        return np.float32(self.read(path, cv2.IMREAD_COLOR))     # RGB
+
+    def read_label(self, path):
+        return self.read(path, cv2.IMREAD_GRAYSCALE).copy()      # 之后会被原地修改
+
+    def get_label_class(self, label):
+        # 当前image中属于 sub_list (train) / sub_val_list (val, test) 的所有cls
         label_class = np.unique(label).tolist()
         if 0 in label_class:
             label_class.remove(0)
@@ -182,20 +370,29 @@ class SemData(Dataset):
             if c in self.sub_list:     # meta train中的cls list
                 if self.mode == 'train':
                     new_label_class.append(c)
-        label_class = new_label_class        # 当前image所有关心的cls
-        assert len(label_class) > 0
+        return new_label_class
 
+    def __getitem__(self, index):
+        if isinstance(index, tuple) and len(index) == 4:     # (query, class_chosen, supports, seed) 由 EpisodeSampler 给出, 这里不再采样
+            query_idx, class_chosen, support_idx_list, seed = index
+            random.seed(seed)                # transform 的随机性只依赖 episode, 与 worker 数及断点续训无关
+            image_path, label_path = self.data_list[query_idx]
+            supports = [self.data_list[idx] for idx in support_idx_list]
+            return self.get_episode(image_path, label_path, class_chosen, [item[0] for item in supports],
+                                    [item[1] for item in supports])
+
+        if isinstance(index, tuple):     # (index, seed) 由 SeededSampler 给出: 采样只依赖 seed, 与 worker 的 RNG 状态无关
+            index, seed = index
+            random.seed(seed)
+        image_path, label_path = self.data_list[index]   # 用每一张图片 作为 query image
+        label = self.read_label(label_path)
+        if label_path not in self.label_class_cache:
+            self.label_class_cache[label_path] = self.get_label_class(label)
+        label_class = self.label_class_cache[label_path]   # 当前image所有关心的cls
+        assert len(label_class) > 0
 
-        # 决定当前任务（segment哪个cls),得到query image的GT label
-        class_chosen = label_class[random.randint(1,len(label_class))-1]   ################## 选取target cls, convert label to binary
-        class_chosen = class_chosen
-        target_pix = np.where(label == class_chosen)
-        ignore_pix = np.where(label == 255)
-        label[:,:] = 0
-        if target_pix[0].shape[0] > 0:
-            label[target_pix[0],target_pix[1]] = 1 
-        label[ignore_pix[0],ignore_pix[1]] = 255           
-
+        # 决定当前任务（segment哪个cls)
+        class_chosen = label_class[random.randint(1,len(label_class))-1]   ################## 选取target cls
 
         file_class_chosen = self.sub_class_file_list[class_chosen]   # 从中选取啊support image
         num_file = len(file_class_chosen)
@@ -214,6 +411,26 @@ class SemData(Dataset):
             support_image_path_list.append(support_image_path)
             support_label_path_list.append(support_label_path)
 
+        return self.get_episode(image_path, label_path, class_chosen, support_image_path_list, support_label_path_list,
+                                label=label)
+
+    def get_episode(self, image_path, label_path, class_chosen, support_image_path_list, support_label_path_list, label=None):
+        # 读取 query 和 support 图片, 按 class_chosen 生成 binary label, 做 transform
+        image = self.read_image(image_path)
+        if label is None:
+            label = self.read_label(label_path)
+
+        if image.shape[0] != label.shape[0] or image.shape[1] != label.shape[1]:
+            raise (RuntimeError("Query Image & label shape mismatch: " + image_path + " " + label_path + "\n"))          
+
+        # 得到query image的GT label, convert label to binary
+        target_pix = np.where(label == class_chosen)
+        ignore_pix = np.where(label == 255)
+        label[:,:] = 0
+        if target_pix[0].shape[0] > 0:
+            label[target_pix[0],target_pix[1]] = 1 
+        label[ignore_pix[0],ignore_pix[1]] = 255           
+
         support_image_list = []        ######################################################## 读取support image & label
         support_label_list = []
         subcls_list = []          # 纪录每张图片所用的cls (有多个cls,只关注一个） index wrt sub_list/sub_val_list
@@ -224,10 +441,8 @@ class SemData(Dataset):
                 subcls_list.append(self.sub_val_list.index(class_chosen))
             support_image_path = support_image_path_list[k]
             support_label_path = support_label_path_list[k] 
-            support_image = cv2.imread(support_image_path, cv2.IMREAD_COLOR)      
-            support_image = cv2.cvtColor(support_image, cv2.COLOR_BGR2RGB)
-            support_image = np.float32(support_image)
-            support_label = cv2.imread(support_label_path, cv2.IMREAD_GRAYSCALE)
+            support_image = self.read_image(support_image_path)
+            support_label = self.read_label(support_label_path)
             target_pix = np.where(support_label == class_chosen)
             ignore_pix = np.where(support_label == 255)
             support_label[:,:] = 0
@@ -242,6 +457,7 @@ class SemData(Dataset):
         raw_label = label.copy()   # query image raw label
         if self.transform is not None:
             image, label = self.transform(image, label)
+            aug_image_list, aug_label_list = [], []
             for k in range(self.shot):
                 if self.meta_aug > 1:
                     org_img, org_label = self.transform(support_image_list[k], support_label_list[k])  # flip and resize
@@ -253,23 +469,26 @@ class SemData(Dataset):
                     elif self.aug_type == 1:
                         new_img, new_label = self.get_aug_data1(fg_ratio, support_image_list[k], support_label_list[k])
 
-                    if new_img is not None:
-                        support_image_list[k] = torch.cat([org_img.unsqueeze(0), new_img], dim=0)
-                        support_label_list[k] = torch.cat([org_label.unsqueeze(0), new_label], dim=0)
-                    else:
-                        support_image_list[k], support_label_list[k] = org_img.unsqueeze(0), org_label.unsqueeze(0)
+                    support_image_list[k], support_label_list[k] = org_img, org_label
+                    aug_image_list.append(new_img)
+                    aug_label_list.append(new_label)
 
                 else:
                     support_image_list[k], support_label_list[k] = self.transform(support_image_list[k], support_label_list[k])
-                    support_image_list[k] = support_image_list[k].unsqueeze(0)
-                    support_label_list[k] = support_label_list[k].unsqueeze(0)
 
-        s_x = torch.cat(support_image_list, 0)
-        s_y = torch.cat(support_label_list, 0)
+            # support 顺序: [orig_1..orig_shot, aug_1..aug_shot], 没有 aug 的 shot 用 orig 补齐; 全部没有 aug 时只有 orig
+            if any(new_img is not None for new_img in aug_image_list):
+                for k in range(self.shot):
+                    support_image_list.append(aug_image_list[k] if aug_image_list[k] is not None else support_image_list[k])
+                    support_label_list.append(aug_label_list[k] if aug_label_list[k] is not None else support_label_list[k])
+
+        # support 不在这里 concat, 由 episode_collate 直接写入 batch tensor
+        s_x = support_image_list
+        s_y = support_label_list
 
         if self.mode == 'train':
             return image, label, s_x, s_y, subcls_list
-            # image: query image (变换后), label: query label(变换后)，s_x: support img concat, s_y:support label concat,
+            # image: query image (变换后), label: query label(变换后)，s_x: list of support img, s_y: list of support label,
             # sub_cls_list, 每个support image所关注的label 对应的index
         else:
             return image, label, s_x, s_y, subcls_list, raw_label
@@ -283,10 +502,10 @@ class SemData(Dataset):
                 scale = self.im_size / max(support_label.shape) * (0.7 if fg_ratio > 0.3 else 0.8)
                 meta_trans = Compose([RandScale(scale=(scale, scale + 0.05), fixed_size=self.im_size, padding=[0, 0, 0])] + self.transform.segtransform[-2:])
             new_img, new_label = meta_trans(support_image, support_label)
-            return new_img.unsqueeze(0), new_label.unsqueeze(0)
+            return new_img, new_label
         else:
             new_img, new_label = self.transform(support_image, support_label)
-            return new_img.unsqueeze(0), new_label.unsqueeze(0)
+            return new_img, new_label
 
     def get_aug_data1(self, fg_ratio, support_image, support_label):   # only size augmentation, no color augmentation
         if fg_ratio <= self.aug_th[0] or fg_ratio >= self.aug_th[1]:
@@ -297,6 +516,320 @@ class SemData(Dataset):
                 scale = self.im_size / max(support_label.shape) * (0.7 if fg_ratio > 0.3 else 0.8)
                 meta_trans = Compose([RandScale(scale=(scale, scale + 0.05), fixed_size=self.im_size, padding=[0,0,0])] + self.transform.segtransform[-2:])
             new_img, new_label = meta_trans(support_image, support_label)
-            return new_img.unsqueeze(0), new_label.unsqueeze(0)
+            return new_img, new_label
         else:
             return None, None
+
+
+class EpisodeSampler(Sampler):
+    """Class-balanced episodes for SemData: yields (query index, class, support indices, seed) w.r.t. data.data_list.
+
+    Classes are visited in reshuffled rounds, so every window of len(classes) episodes covers each class once
+    (a batch never repeats a class while batch_size <= number of classes). The query is drawn uniformly from the
+    class files and the supports without replacement from the rest, in O(shot) per episode.
+    The episodes of an epoch depend only on (seed, epoch), see set_epoch; the per-episode seed drives the
+    transforms. start skips the first episodes of the epoch (resuming in the middle of an epoch).
+    With num_replicas > 1 (DDP) every rank draws the same sequence and takes every num_replicas-th episode,
+    like DistributedSampler; each rank gets ceil(episode_num / num_replicas) episodes and start counts them.
+    """
+    def __init__(self, data, episode_num=None, seed=0, num_replicas=1, rank=0):
+        self.shot = data.shot
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.num_samples = -(-(episode_num or len(data.data_list)) // num_replicas)    # 每个 rank 的 episode 数
+        self.episode_num = self.num_samples * num_replicas
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+
+        self.class_files = {}      # class -> int32 array of data_list indices
+        for c in sorted(data.sub_class_file_list.keys()):
+            files = data.sub_class_file_list[c].indices
+            if len(files) > self.shot:
+                self.class_files[c] = files
+            elif len(files) > 0:
+                print("INFO: EpisodeSampler skips class {} ({} images for {} shot)".format(c, len(files), self.shot))
+        assert len(self.class_files) > 0, "no class has more than {} images".format(self.shot)
+        self.classes = np.array(list(self.class_files.keys()), dtype=np.int32)
+
+    def __len__(self):
+        return self.num_samples
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self.start = 0
+
+    def state_dict(self):
+        return {'seed': self.seed, 'epoch': self.epoch, 'start': self.start}
+
+    def load_state_dict(self, state_dict):
+        assert state_dict['seed'] == self.seed, "sampler seed changed: {} vs {}".format(state_dict['seed'], self.seed)
+        self.epoch = state_dict['epoch']
+        self.start = state_dict['start']
+
+    def __iter__(self):
+        rng = np.random.default_rng([self.seed, self.epoch])
+        rounds = -(-self.episode_num // len(self.classes))
+        class_seq = np.concatenate([rng.permutation(self.classes) for _ in range(rounds)])[:self.episode_num]
+        for e_idx, c in enumerate(class_seq.tolist()):
+            files = self.class_files[c]
+            q = int(rng.integers(len(files)))
+            support = []     # Floyd 不放回抽样: 从 len(files)-1 个非 query 文件中选 shot 个
+            for j in range(len(files) - 1 - self.shot, len(files) - 1):
+                t = int(rng.integers(j + 1))
+                support.append(j if t in support else t)
+            seed = int(rng.integers(2**31))
+            # 跳过的 episode 也要抽样, 保证之后的 episode 不变
+            if e_idx % self.num_replicas == self.rank and e_idx // self.num_replicas >= self.start:
+                yield int(files[q]), c, tuple(int(files[t + (t >= q)]) for t in support), seed     # 跳过 query 自身
+
+
+class SeededSampler(Sampler):
+    """Yields (index, seed) for the indices of SemData, which then samples the episode of that index from its seed.
+
+    The episodes do not depend on the worker that loads them (persistent workers keep their RNG state across
+    epochs) but only on (seed, epoch); set_epoch selects the seeds of a pass. shuffle (train): each pass also
+    visits the indices in a permutation drawn from (seed, epoch).
+    passes/num/rank/world_size (DDP validate): the first num items of `passes` consecutive passes from the current
+    epoch on, of which this rank takes every world_size-th; the ranks together see exactly the serial episodes.
+    start skips the first items of this rank (resuming in the middle of an epoch, see EpisodeSampler).
+    """
+    def __init__(self, indices, seed=0, passes=1, num=None, rank=0, world_size=1, shuffle=False):
+        self.indices = indices
+        self.seed = seed
+        self.epoch = 0
+        self.passes = passes
+        self.num = num
+        self.rank = rank
+        self.world_size = world_size
+        self.shuffle = shuffle
+        self.start = 0
+
+    def __len__(self):
+        total = len(self.indices) * self.passes
+        if self.num is not None:
+            total = min(total, self.num)
+        return len(range(self.rank, total, self.world_size))
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self.start = 0
+
+    def state_dict(self):
+        return {'seed': self.seed, 'epoch': self.epoch, 'start': self.start}
+
+    def load_state_dict(self, state_dict):
+        assert state_dict['seed'] == self.seed, "sampler seed changed: {} vs {}".format(state_dict['seed'], self.seed)
+        self.epoch = state_dict['epoch']
+        self.start = state_dict['start']
+
+    def __iter__(self):
+        total = len(self.indices) * self.passes if self.num is None else min(len(self.indices) * self.passes, self.num)
+        k = 0
+        for e in range(self.passes):
+            rng = np.random.default_rng([self.seed, self.epoch + e])
+            seeds = rng.integers(2 ** 31, size=len(self.indices))
+            indices = [self.indices[k] for k in rng.permutation(len(self.indices))] if self.shuffle else self.indices
+            for index, seed in zip(indices, seeds):
+                if k >= total:
+                    return
+                if k % self.world_size == self.rank and k // self.world_size >= self.start:
+                    yield int(index), int(seed)
+                k += 1
+
+
+class EpisodeDataset(SemData):
+    # 按 episode list 文件 (由 gen_episodes.py 生成) 重放评测任务, 结果与 num_workers 及机器无关
+    # episodes: 已生成的 episodes (make_episodes 的结果), 此时不读 episode_list
+    def __init__(self, split=3, shot=1, data_root=None, episode_list=None, transform=None, mode='val', use_coco=False,
+                 use_split_coco=False, args={}, episodes=None, meta_aug=None):
+        super(EpisodeDataset, self).__init__(split=split, shot=shot, data_root=data_root, data_list=None, transform=transform,
+                                             mode=mode, use_coco=use_coco, use_split_coco=use_split_coco, args=args, meta_aug=meta_aug)
+        self.episodes = episodes if episodes is not None else load_episodes(episode_list, data_root)
+        self.seed = args.get('manual_seed', None) or 0
+        for _, _, class_chosen, supports in self.episodes:
+            assert len(supports) >= self.shot, "episode list has fewer than {} supports".format(self.shot)
+            assert class_chosen in (self.sub_list if self.mode == 'train' else self.sub_val_list)
+        print("Loaded {} episodes from {}".format(len(self.episodes), episode_list or 'memory'))
+
+    def __len__(self):
+        return len(self.episodes)
+
+    def __getitem__(self, index):
+        image_path, label_path, class_chosen, supports = self.episodes[index]
+        if self.meta_aug > 1:
+            random.seed(self.seed + index)     # support augmentation 只依赖 episode index
+        support_image_path_list = [support[0] for support in supports[:self.shot]]
+        support_label_path_list = [support[1] for support in supports[:self.shot]]
+        return self.get_episode(image_path, label_path, class_chosen, support_image_path_list, support_label_path_list)
+
+
+def new_batch_tensor(shape, dtype):
+    # 在 DataLoader worker 中直接分配 shared memory, 传回主进程时不用再拷贝 (同 default_collate)
+    out = torch.empty(shape, dtype=dtype)
+    if get_worker_info() is not None:
+        out.share_memory_()
+    return out
+
+
+def episode_collate(batch):
+    """Collate SemData episodes, writing every support view straight into one [B, V, ...] batch tensor.
+
+    Episodes with fewer support views (meta_aug) are padded: images with 0, labels with 255. The returned
+    batch is the dataset tuple with s_x/s_y stacked, plus s_valid ([B, V] bool, None when nothing is padded).
+    """
+    support_num = [len(episode[2]) for episode in batch]
+    max_num = max(support_num)
+    s_img, s_lbl = batch[0][2][0], batch[0][3][0]
+    s_x = new_batch_tensor((len(batch), max_num) + tuple(s_img.shape), s_img.dtype)
+    s_y = new_batch_tensor((len(batch), max_num) + tuple(s_lbl.shape), s_lbl.dtype)
+    for i, episode in enumerate(batch):
+        for k in range(support_num[i]):
+            s_x[i, k].copy_(episode[2][k])
+            s_y[i, k].copy_(episode[3][k])
+        if support_num[i] < max_num:
+            s_x[i, support_num[i]:].zero_()
+            s_y[i, support_num[i]:].fill_(255)
+    s_valid = None
+    if min(support_num) < max_num:
+        s_valid = torch.arange(max_num).unsqueeze(0) < torch.tensor(support_num).unsqueeze(1)
+
+    rest = [default_collate([episode[j] for episode in batch]) for j in range(4, len(batch[0]))]
+    return [default_collate([episode[0] for episode in batch]), default_collate([episode[1] for episode in batch]),
+            s_x, s_y] + rest + [s_valid]
+
+
+def available_cpus():
+    # 本进程可用的 cpu 数 (taskset / SLURM --cpus-per-task 限制的 affinity), 而不是机器的核数
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def autotune_loader(data, batch_size, sampler=None, cpus=None, num_batches=8, logger=None, **kwargs):
+    """Picks num_workers, prefetch_factor and persistent_workers for a DataLoader over data by measuring episodes/s.
+
+    Coordinate search: num_workers in 0, 1, 2, 4, ... up to cpus - 1 (one cpu is left to the training process),
+    then prefetch_factor, then persistent_workers. Each setting loads num_batches batches twice (two "epochs",
+    so worker start-up is counted); the fewest workers within 5% of the best throughput win.
+    kwargs (collate_fn, pin_memory, ...) are passed to the DataLoader. Returns the chosen DataLoader kwargs.
+    """
+    cpus = cpus or available_cpus()
+    max_workers = max(1, cpus - 1)
+    worker_list = sorted(set([0] + [2 ** k for k in range(8) if 2 ** k <= max_workers] + [max_workers]))
+
+    def measure(num_workers, prefetch_factor=2, persistent_workers=False):
+        setting = {'num_workers': num_workers}
+        if num_workers > 0:
+            setting.update(prefetch_factor=prefetch_factor, persistent_workers=persistent_workers)
+        loader = DataLoader(data, batch_size=batch_size, sampler=sampler, shuffle=False, drop_last=True,
+                            generator=torch.Generator(), **dict(kwargs, **setting))
+        start = time.time()
+        for _ in range(2):
+            for _ in zip(range(num_batches), loader):
+                pass
+        speed = 2 * num_batches * batch_size / (time.time() - start)
+        del loader
+        if logger is not None:
+            logger.info('=> autotune loader: {} {:.2f} episodes/s'.format(setting, speed))
+        return speed, setting
+
+    def best(results):
+        top = max(speed for speed, _ in results)
+        return min((s for s in results if s[0] >= 0.95 * top), key=lambda s: s[1]['num_workers'])
+
+    speed, setting = best([measure(w, persistent_workers=w > 0) for w in worker_list])
+    if setting['num_workers'] > 0:
+        w = setting['num_workers']
+        speed, setting = best([(speed, setting)] + [measure(w, p, True) for p in (4, 8)])
+        speed, setting = best([measure(w, setting['prefetch_factor'], False), (speed, setting)])
+    if logger is not None:
+        logger.info('=> autotune loader: {} cpus available, chose {} ({:.2f} episodes/s)'.format(cpus, setting, speed))
+    return setting
+
+
+class PrefetchLoader(object):
+    """Wraps a DataLoader: a background thread fetches (and collates) the next batches and, on cuda, stages them
+    in reused pinned buffers and copies them to the device on a side stream. Top-level tensors of each batch
+    are handed over on the target device; other items (e.g. subcls lists) are passed through unchanged.
+    """
+    def __init__(self, loader, device, depth=2):
+        self.loader = loader
+        self.device = device
+        self.depth = max(1, depth)
+        self.buffers = {}      # (slot, index) -> pinned host buffer
+        self.events = {}       # slot -> cuda event of the last copy out of the slot
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getattr__(self, name):   # dataset, batch_size, sampler ...
+        return getattr(self.__dict__['loader'], name)
+
+    def __iter__(self):
+        # 在主线程创建 iterator, sampler/worker 的随机种子与不用 prefetch 时一致
+        batches = iter(self.loader)
+        ready = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        thread = threading.Thread(target=self.fetch, args=(batches, ready, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = ready.get()
+                if item is None:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                batch, event = item
+                if event is not None:     # 只让计算 stream 等待拷贝完成, host 不阻塞
+                    stream = torch.cuda.current_stream(self.device)
+                    stream.wait_event(event)
+                    for t in batch:
+                        if torch.is_tensor(t) and t.is_cuda:
+                            t.record_stream(stream)
+                yield batch
+        finally:
+            stop.set()
+            while thread.is_alive():
+                try:
+                    ready.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            thread.join()
+
+    def fetch(self, batches, ready, stop):
+        stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+        try:
+            for i, batch in enumerate(batches):
+                if stop.is_set():
+                    return
+                event = None
+                if stream is not None:
+                    slot = i % (self.depth + 2)    # depth 个在队列中, 1 个正在使用, 1 个正在拷贝
+                    if slot in self.events:
+                        self.events[slot].synchronize()
+                    with torch.cuda.stream(stream):
+                        batch = [self.to_device(slot, k, t) if torch.is_tensor(t) else t for k, t in enumerate(batch)]
+                        event = torch.cuda.Event()
+                        event.record(stream)
+                    self.events[slot] = event
+                while not stop.is_set():
+                    try:
+                        ready.put((batch, event), timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+        except BaseException as e:
+            ready.put(e)
+            return
+        ready.put(None)
+
+    def to_device(self, slot, k, t):
+        if not t.is_pinned():
+            buf = self.buffers.get((slot, k))
+            if buf is None or buf.shape != t.shape or buf.dtype != t.dtype:
+                buf = torch.empty(t.shape, dtype=t.dtype).pin_memory()
+                self.buffers[(slot, k)] = buf
+            t = buf.copy_(t)
+        return t.to(self.device, non_blocking=True)
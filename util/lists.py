@@ -0,0 +1,76 @@
+# encoding:utf-8
+# train/val list 文件工具: 每行 "image_path label_path", 路径相对于 data_root
+# 所有函数都逐行流式处理 (不 readlines), 百万行的 list 也是线性时间、常数内存 (去重时为每行 16 字节的 hash)
+import os
+import hashlib
+import zlib
+
+
+def read_list(data_list):
+    """Yield the (image path, label path) pairs of a list file, one line at a time (blank lines are skipped)."""
+    if not os.path.isfile(data_list):
+        raise (RuntimeError("Image list file do not exist: " + data_list + "\n"))
+    with open(data_list) as f:
+        for line_num, line in enumerate(f, 1):
+            line_split = line.split()
+            if not line_split:
+                continue
+            if len(line_split) != 2:
+                raise (RuntimeError("Invalid line {} in {}: {}\n".format(line_num, data_list, line.rstrip('\n'))))
+            yield line_split[0], line_split[1]
+
+
+def write_list(pairs, data_list):
+    """Write (image path, label path) pairs to a list file, return the number of lines."""
+    list_dir = os.path.dirname(data_list)
+    if list_dir and not os.path.exists(list_dir):
+        os.makedirs(list_dir)
+    count = 0
+    with open(data_list, 'w') as f:
+        for image_path, label_path in pairs:
+            f.write(image_path + ' ' + label_path + '\n')
+            count += 1
+    return count
+
+
+def unique(pairs):
+    """Drop repeated pairs, keeping the first occurrence and the order."""
+    seen = set()
+    for pair in pairs:
+        key = hashlib.blake2b('\0'.join(pair).encode('utf-8'), digest_size=16).digest()
+        if key not in seen:
+            seen.add(key)
+            yield pair
+
+
+def merge(data_lists):
+    """Concatenate list files and remove the duplicates (e.g. voc_original_train.txt + sbd_data.txt)."""
+    return unique(pair for data_list in data_lists for pair in read_list(data_list))
+
+
+def is_val(image_path, val_ratio, seed=0):
+    """Stable train/val assignment of an image: hash of (seed, image path), independent of the order and of the other lines."""
+    return zlib.crc32('{}:{}'.format(seed, image_path).encode('utf-8')) % 1000000 < val_ratio * 1000000
+
+
+def split(pairs, train_list, val_list, val_ratio, seed=0):
+    """Write pairs to train_list / val_list according to is_val, return the two line counts."""
+    counts = [0, 0]
+    for data_list in [train_list, val_list]:
+        list_dir = os.path.dirname(data_list)
+        if list_dir and not os.path.exists(list_dir):
+            os.makedirs(list_dir)
+    with open(train_list, 'w') as f_train, open(val_list, 'w') as f_val:
+        for image_path, label_path in pairs:
+            v = int(is_val(image_path, val_ratio, seed))
+            (f_val if v else f_train).write(image_path + ' ' + label_path + '\n')
+            counts[v] += 1
+    return counts[0], counts[1]
+
+
+def missing_files(pairs, data_root=None):
+    """Yield (line index, path) for every image/label path that does not exist under data_root."""
+    for idx, pair in enumerate(pairs):
+        for path in pair:
+            if not os.path.isfile(os.path.join(data_root or '', path)):
+                yield idx, path
@@ -1,6 +1,10 @@
 # encoding:utf-8
 
 import os
+import random
+import hashlib
+import threading
+import queue
 import numpy as np
 from PIL import Image
 
@@ -80,6 +84,317 @@ def intersectionAndUnionGPU(output, target, K, ignore_index=255):
     area_union = area_output + area_target - area_intersection              # Union [num0, num1]
     return area_intersection, area_union, area_target
 
+class IntersectionAndUnionMeter(object):
+    """Accumulates an exact (int64) confusion matrix per episode class, kept on the device of the predictions.
+
+    Each update is a single scatter-add into the [split_gap, K, K] matrix (slot, target, pred), with no
+    host sync; counts are copied to the host only when the results are read. Meters of disjoint episode
+    subsets can be merged, and the merged results are identical to a single pass over all episodes.
+    """
+    def __init__(self, classes=2, split_gap=5, ignore_index=255):
+        self.classes = classes
+        self.split_gap = split_gap
+        self.ignore_index = ignore_index
+        self.reset()
+
+    def reset(self):
+        # 最后多一个 bin 存放 ignore_index / 越界的 pixel, 读取时丢掉
+        self.confusion = torch.zeros(self.split_gap * self.classes * self.classes + 1, dtype=torch.long)
+        self.count = 0
+
+    def update(self, output, target, subcls):
+        # output/target: [B, h, w] prediction and label of one episode class, subcls: index of its class (int or cpu tensor/array)
+        # returns the intersection/union/target of this step as device tensors (not synced)
+        K = self.classes
+        if self.confusion.device != output.device:
+            self.confusion = self.confusion.to(output.device)
+        output = output.reshape(-1).long()
+        target = target.reshape(-1).long()
+        slot = (int(np.asarray(subcls).reshape(-1)[0]) - 1) % self.split_gap    # host 上的 int, 不拷贝到 device
+        valid = (target >= 0) & (target < K)
+        index = target * K + output + slot * K * K
+        index = torch.where(valid, index, torch.full_like(index, self.split_gap * K * K))
+        step = torch.zeros_like(self.confusion).index_add_(0, index, torch.ones_like(index))
+        self.confusion += step
+        self.count += 1
+        step = step[:-1].view(self.split_gap, K, K).sum(0)
+        intersection = step.diagonal()
+        return intersection, step.sum(0) + step.sum(1) - intersection, step.sum(1)
+
+    def merge(self, other):
+        assert self.classes == other.classes and self.split_gap == other.split_gap
+        self.confusion += other.confusion.to(self.confusion.device)
+        self.count += other.count
+
+    def state_dict(self):
+        return {'confusion': self.confusion.cpu().clone(), 'count': self.count}
+
+    def load_state_dict(self, state_dict):
+        assert len(state_dict['confusion']) == len(self.confusion)
+        self.confusion = torch.as_tensor(state_dict['confusion']).to(self.confusion.device, torch.long)
+        self.count = state_dict['count']
+
+    def get_counts(self):
+        # host copy of the counts: intersection/union/target [K] and FG intersection/union of each episode class [split_gap]
+        K = self.classes
+        confusion = self.confusion[:-1].cpu().numpy().reshape(self.split_gap, K, K)
+        class_intersection = np.diagonal(confusion, axis1=1, axis2=2)                                # [split_gap, K]
+        class_union = confusion.sum(1) + confusion.sum(2) - class_intersection
+        intersection, union, target = class_intersection.sum(0), class_union.sum(0), confusion.sum((0, 2))
+        return intersection, union, target, class_intersection[:, 1], class_union[:, 1]
+
+    def get_results(self):
+        intersection, union, target, class_intersection, class_union = self.get_counts()
+        iou_class = intersection / (union + 1e-10)
+        accuracy_class = intersection / (target + 1e-10)
+        mIoU = np.mean(iou_class)
+        mAcc = np.mean(accuracy_class)
+        allAcc = sum(intersection) / (sum(target) + 1e-10)
+        class_iou_class = class_intersection / (class_union + 1e-10)
+        class_miou = np.mean(class_iou_class)
+        return mIoU, mAcc, allAcc, class_miou, iou_class, accuracy_class, class_iou_class
+
+
+class TrainMeter(object):
+    """Training losses and pixel counts accumulated as device tensors.
+
+    update() never syncs; the per-step values are buffered on the device and copied to the host
+    in one transfer by flush(), which train() calls every print_freq steps.
+    """
+    def __init__(self, classes=2, ignore_index=255):
+        self.classes = classes
+        self.meter = IntersectionAndUnionMeter(classes, 1, ignore_index)
+        self.reset()
+
+    def reset(self):
+        self.meter.reset()
+        self.loss_sum = torch.zeros(3, dtype=torch.double)   # main / aux / total loss, summed over samples
+        self.count = 0
+        self.steps = []
+
+    def update(self, main_loss, aux_loss, loss, output, target, n=1):
+        losses = torch.stack([main_loss.detach(), aux_loss.detach(), loss.detach()]).double()
+        if self.loss_sum.device != losses.device:
+            self.loss_sum = self.loss_sum.to(losses.device)
+        self.loss_sum += losses * n
+        self.count += n
+        intersection, union, target = self.meter.update(output, target, 1)
+        self.steps.append(torch.cat([losses, intersection.double(), union.double(), target.double()]))
+
+    def flush(self):
+        # steps buffered since the last flush: list of (main_loss, aux_loss, loss, intersection, union, target)
+        if len(self.steps) == 0:
+            return []
+        K = self.classes
+        steps = torch.stack(self.steps).cpu().numpy()
+        self.steps = []
+        return [(step[0], step[1], step[2], step[3:3+K], step[3+K:3+2*K], step[3+2*K:]) for step in steps]
+
+    def get_results(self):
+        # main/aux/total loss averages and mIoU, mAcc, allAcc, iou_class, accuracy_class
+        main_loss, aux_loss, loss = (self.loss_sum.cpu().numpy() / max(self.count, 1)).tolist()
+        mIoU, mAcc, allAcc, _, iou_class, accuracy_class, _ = self.meter.get_results()
+        return main_loss, aux_loss, loss, mIoU, mAcc, allAcc, iou_class, accuracy_class
+
+    def state_dict(self):
+        # flush() 之后调用, 缓存的 per-step 值不保存
+        return {'loss_sum': self.loss_sum.cpu(), 'count': self.count, 'meter': self.meter.state_dict()}
+
+    def load_state_dict(self, state_dict):
+        self.loss_sum = torch.as_tensor(state_dict['loss_sum'], dtype=torch.double)
+        self.count = state_dict['count']
+        self.meter.load_state_dict(state_dict['meter'])
+        self.steps = []
+
+
+def get_rng_state():
+    """RNG states of random, numpy, torch and (if available) all cuda devices, as tensors/python values for torch.save"""
+    np_state = np.random.get_state()
+    np_state = (np_state[0], torch.from_numpy(np_state[1].astype(np.int64))) + tuple(np_state[2:])
+    state = {'random': random.getstate(), 'numpy': np_state, 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['random'])
+    np_state = state['numpy']
+    np.random.set_state((np_state[0], np.asarray(np_state[1], dtype=np.int64).astype(np.uint32)) + tuple(np_state[2:]))
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def get_amp_dtype(args, device):
+    """Reduced precision dtype selected by use_apex/opt_level: None for fp32 (O0), bf16 on cpu, fp16 on gpu"""
+    if not args.get('use_apex', False) or args.get('opt_level', 'O0') in [None, 'O0']:
+        return None
+    return torch.float16 if device.type == 'cuda' else torch.bfloat16
+
+
+def amp_autocast(device, dtype):
+    return torch.autocast(device_type=device.type, dtype=dtype or torch.bfloat16, enabled=dtype is not None)
+
+
+def get_grad_scaler(args, dtype):
+    """GradScaler for fp16 (a no-op otherwise); loss_scale fixes the scale, empty means dynamic scaling"""
+    kwargs = {'enabled': dtype == torch.float16}
+    if args.get('loss_scale', None):
+        kwargs.update(init_scale=float(args.loss_scale), growth_interval=2**31 - 1)
+    if hasattr(torch, 'amp') and hasattr(torch.amp, 'GradScaler'):
+        return torch.amp.GradScaler('cuda', **kwargs)
+    return torch.cuda.amp.GradScaler(**kwargs)
+
+
+def cast_backbone(model, dtype, opt_level='O2', keep_batchnorm_fp32=None):
+    """O2/O3: store and run the frozen backbone (layer0-4) in reduced precision, BN stays fp32 by default for O2"""
+    if opt_level not in ['O2', 'O3']:
+        return
+    if keep_batchnorm_fp32 is None:
+        keep_batchnorm_fp32 = opt_level == 'O2'
+    for layer in [model.layer0, model.layer1, model.layer2, model.layer3, model.layer4]:
+        layer.to(dtype)
+        if keep_batchnorm_fp32:
+            for m in layer.modules():
+                if isinstance(m, nn.modules.batchnorm._BatchNorm):
+                    m.float()
+
+
+def atomic_save(obj, filename):
+    """torch.save to a temporary file and rename it into place, so an interrupted save never leaves a truncated file"""
+    tmp_filename = filename + '.tmp'
+    torch.save(obj, tmp_filename)
+    os.replace(tmp_filename, filename)
+
+
+BACKBONE_LAYERS = ['layer0', 'layer1', 'layer2', 'layer3', 'layer4']
+
+
+def backbone_param_names(model):
+    return [name for name, _ in model.named_parameters() if name.split('.')[0] in BACKBONE_LAYERS]
+
+
+def tensors_hash(tensors):
+    # tensors: (name, tensor) pairs, hashed as fp32
+    h = hashlib.sha256()
+    for name, t in tensors:
+        h.update(name.encode())
+        h.update(t.detach().float().cpu().contiguous().numpy().tobytes())
+    return h.hexdigest()
+
+
+def backbone_hash(model):
+    """sha256 of the frozen backbone parameters (as fp32), identifies the pretrained weights a head-only checkpoint needs"""
+    params = dict(model.named_parameters())
+    return tensors_hash((name, params[name]) for name in backbone_param_names(model))
+
+
+def head_hash(model):
+    """sha256 of head_state_dict (trained weights and BN running stats): the model changed iff it changed"""
+    return tensors_hash(sorted(head_state_dict(model).items()))
+
+
+def head_state_dict(model):
+    # 不保存冻结的 backbone 参数 (与 initmodel 中的预训练权重相同); BN 的 running stats 训练时会变, 仍然保存
+    skip = set(backbone_param_names(model))
+    return {k: v for k, v in model.state_dict().items() if k not in skip}
+
+
+def load_checkpoint_weights(model, checkpoint, expected_hash=None, assign=False):
+    """Load a full ('state_dict') or head-only ('backbone_hash') checkpoint into a model built with the pretrained backbone
+    (assign: use the checkpoint tensors as the parameters instead of copying them, see util.weight_store)"""
+    state_dict = checkpoint['state_dict']
+    # checkpoints saved from DataParallel models carry a 'module.' prefix
+    state_dict = {(k[len('module.'):] if k.startswith('module.') else k): v for k, v in state_dict.items()}
+    if 'backbone_hash' not in checkpoint:
+        model.load_state_dict(state_dict, assign=assign)
+        return
+    current_hash = expected_hash or backbone_hash(model)
+    if checkpoint['backbone_hash'] != current_hash:
+        raise (RuntimeError("Head-only checkpoint was trained on backbone {} ({}), the model has {}\n".format(
+            checkpoint.get('backbone'), checkpoint['backbone_hash'][:12], current_hash[:12])))
+    missing, unexpected = model.load_state_dict(state_dict, strict=False, assign=assign)
+    assert len(unexpected) == 0 and set(missing) == set(backbone_param_names(model)), (missing, unexpected)
+
+
+def cpu_snapshot(obj):
+    """Copy of a (nested) state: tensors are cloned to cpu, so training can go on while it is written"""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, cpu_snapshot(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)) and not hasattr(obj, '_fields'):
+        return type(obj)(cpu_snapshot(v) for v in obj)
+    return obj
+
+
+class CheckpointWriter(object):
+    """Writes checkpoints with atomic_save on a background thread and applies a retention policy.
+
+    save() takes a cpu snapshot of the state and returns; at most `depth` snapshots wait in the queue.
+    kind='best' files keep the keep_best ones with the highest metric, kind='last' files the keep_last newest
+    (0: keep all); other files (latest.pth, final.pth) are only ever replaced. close() waits for all writes.
+    """
+    def __init__(self, keep_best=0, keep_last=0, depth=2, logger=None):
+        self.keep = {'best': keep_best, 'last': keep_last}
+        self.files = {'best': [], 'last': []}    # (metric or save order, filename)
+        self.logger = logger
+        self.order = 0
+        self.error = None
+        self.jobs = queue.Queue(maxsize=depth)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def save(self, state, filename, kind=None, metric=None):
+        self.check()
+        self.order += 1
+        key = metric if kind == 'best' else self.order
+        self.jobs.put((cpu_snapshot(state), filename, kind, key))
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                if job is None:
+                    return
+                if self.error is None:
+                    self.write(*job)
+            except BaseException as e:
+                self.error = e
+            finally:
+                self.jobs.task_done()
+
+    def write(self, state, filename, kind, key):
+        atomic_save(state, filename)
+        if self.logger is not None:
+            self.logger.info('Saved checkpoint: ' + filename)
+        if kind not in self.files:
+            return
+        files = [item for item in self.files[kind] if item[1] != filename] + [(key, filename)]
+        files.sort(key=lambda item: item[0], reverse=True)
+        if self.keep[kind] > 0:
+            for _, old in files[self.keep[kind]:]:
+                if os.path.exists(old):
+                    os.remove(old)
+            files = files[:self.keep[kind]]
+        self.files[kind] = files
+
+    def wait(self):
+        self.jobs.join()
+        self.check()
+
+    def close(self):
+        self.jobs.put(None)
+        self.thread.join()
+        self.check()
+
+    def check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+
 def check_mkdir(dir_name):
     if not os.path.exists(dir_name):
         os.mkdir(dir_name)
@@ -0,0 +1,60 @@
+# encoding:utf-8
+# 用 mmap 的权重文件直接构建模型: 在 meta device 上创建 (不随机初始化, 不分配内存), 再把 checkpoint / initmodel 中的 tensor 作为参数
+# mmap 的 tensor 在第一次用到时才从 page cache 读入, 同一台机器上的多个进程 (eval_shards, DDP) 共享这些页
+import os
+import hashlib
+import zipfile
+
+import torch
+
+from .util import load_checkpoint_weights
+
+
+def load_weights(path, cache_dir=None):
+    """torch.load a weight file memory-mapped.
+
+    Files in the legacy (pytorch < 1.6, non-zip) format cannot be mapped: they are converted once to cache_dir
+    (default: a cache directory next to the file) and the copy is mapped from then on.
+    """
+    if not zipfile.is_zipfile(path):
+        path = convert_weights(path, cache_dir or os.path.join(os.path.dirname(path), 'cache'))
+    return torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+
+
+def convert_weights(path, cache_dir):
+    # 转存的文件由原文件的 (路径, 大小, 修改时间) 决定, 原文件变了就重新转存
+    stat = os.stat(path)
+    key = repr([os.path.abspath(path), stat.st_size, stat.st_mtime_ns])
+    name = '{}_{}.pth'.format(os.path.splitext(os.path.basename(path))[0], hashlib.sha1(key.encode('utf-8')).hexdigest()[:16])
+    cache_file = os.path.join(cache_dir, name)
+    if not os.path.isfile(cache_file):
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+        tmp_file = '{}.tmp{}'.format(cache_file, os.getpid())    # 多个进程同时转存时, 各写各的再 rename
+        torch.save(torch.load(path, map_location='cpu', weights_only=True), tmp_file)
+        os.replace(tmp_file, cache_file)
+    return cache_file
+
+
+def build_model(model_fn, weight, cache_dir=None):
+    """Build model_fn() from a full or head-only (train.py save_head_only) checkpoint without initializing it first.
+
+    model_fn must build the model with pretrained=False; it runs on the meta device. For head-only checkpoints the
+    frozen backbone parameters are taken from the model's backbone_path, with the keys in backbone_keys (see PFENet).
+    """
+    with torch.device('meta'):
+        model = model_fn()
+    checkpoint = load_weights(weight, cache_dir)
+    if 'backbone_hash' in checkpoint:
+        backbone_path = model.backbone_path
+        pretrained = load_weights(backbone_path, cache_dir)
+        params = dict(model.named_parameters())
+        missing = [k for k, src in model.backbone_keys.items() if k in params and src not in pretrained]
+        if missing:
+            raise (RuntimeError("Backbone weights {} miss {}\n".format(backbone_path, missing)))
+        model.load_state_dict({k: pretrained[src] for k, src in model.backbone_keys.items() if k in params}, strict=False, assign=True)
+    load_checkpoint_weights(model, checkpoint, assign=True)
+    left = [k for k, v in list(model.named_parameters()) + list(model.named_buffers()) if v.is_meta]
+    if left:
+        raise (RuntimeError("Not in {}: {}\n".format(weight, left)))
+    return model